@@ -0,0 +1,375 @@
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import deque
+from contextlib import contextmanager
+
+MODEL = "gpt-4o-mini"
+PROMPT_VERSION = 1
+
+# 暴走した生成を打ち切る上限
+MAX_RESPONSE_CHARS = 20000
+MAX_SECONDS = 90
+# 途中経過のJSONを解析する間隔 (秒)。チャンクごとに解析すると遅くなるため間引く
+PARSE_INTERVAL = 0.2
+
+
+# 同時に OpenAI へ送るリクエスト数 (プロセス全体) と再試行の設定
+MAX_CONCURRENT_REQUESTS = 4
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1.0  # 秒
+RETRY_MAX_DELAY = 20.0  # 秒
+
+
+class GenerationAborted(Exception):
+    """上限を超えたため生成を打ち切った"""
+
+
+def build_prompt(theme):
+    # 日本語キーワードを強制するプロンプトに変更
+    return f"""
+                        あなたはプロの診断作家です。テーマ: {theme}
+                        【絶対厳守】
+                        1. 質問は「必ず5問」作成すること。
+                        2. 選択肢は「必ず4つ」作成すること。
+                        3. 結果パターンは「必ず3つ（A, B, C）」作成すること。
+                        4. JSONのみ出力
+
+                        【画像キーワードについて】
+                        image_keywordは、必ず「英単語1語」で出力してください。（例: cat, ocean, future, business）
+
+                        出力JSON:
+                        {{
+                            "page_title": "", "main_heading": "", "intro_text": "", "image_keyword": "英単語1語",
+                            "results": {{ "A": {{ "title": "", "desc": "600字", "btn": "", "link":"" }}, "B": {{...}}, "C": {{...}} }},
+                            "questions": [ {{ "question": "", "answers": [ {{ "text": "", "type": "A" }}, {{ "text": "", "type": "B" }}, {{ "text": "", "type": "C" }}, {{ "text": "", "type": "A" }} ] }} ]
+                        }}
+                        """
+
+
+def build_messages(theme):
+    return [{"role": "system", "content": "Output JSON only"}, {"role": "user", "content": build_prompt(theme)}]
+
+
+def _closers(stack):
+    return "".join("}" if c == "{" else "]" for c in reversed(stack))
+
+
+def parse_partial_json(text):
+    """途中までしか届いていないJSONを、読めるところまで dict/list にして返す
+
+    書きかけの文字列値はそこまでの内容で閉じる。書きかけのキーや数値は捨てる。
+    何も読めない場合は None。
+    """
+    stack = []
+    in_string = escaped = is_key = False
+    expecting_key = False
+    safe = None  # (切り取り位置, 閉じ括弧)
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+                if not is_key:
+                    safe = (i + 1, _closers(stack))
+            continue
+        if ch == '"':
+            in_string = True
+            is_key = bool(stack) and stack[-1] == "{" and expecting_key
+            expecting_key = False
+        elif ch in "{[":
+            stack.append(ch)
+            expecting_key = ch == "{"
+            safe = (i + 1, _closers(stack))
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            expecting_key = False
+            safe = (i + 1, _closers(stack))
+        elif ch == ",":
+            # 直前の値 (数値・true 等を含む) はここで確定する
+            safe = (i, _closers(stack))
+            expecting_key = bool(stack) and stack[-1] == "{"
+
+    candidates = []
+    if in_string and not is_key:
+        end = len(text) - 1 if escaped else len(text)
+        candidates.append(text[:end] + '"' + _closers(stack))
+    if safe is not None:
+        candidates.append(text[:safe[0]].rstrip().rstrip(",") + safe[1])
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            continue
+    return None
+
+
+def _is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # 接続エラー・タイムアウト (openai.APIConnectionError / APITimeoutError)
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def call_with_retries(fn, retries=MAX_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """429 / 5xx / 接続エラーのときだけ、ジッター付き指数バックオフで再試行する"""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries or not _is_retryable(e):
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            time.sleep(min(delay, max_delay))
+
+
+class RequestGate:
+    """OpenAI への同時リクエスト数を制限する、先着順 (FIFO) の待ち行列
+
+        with gate.slot(on_wait=lambda position: ...):
+            ...  # ここは同時に max_concurrent 件までしか実行されない
+
+    on_wait には待ち順 (1 = 次) が渡される。待っている間に例外が起きた場合
+    (Streamlit の再実行など) は行列から外れる。
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_REQUESTS):
+        self.max_concurrent = max_concurrent
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._active = 0
+        self.stats = {"admitted": 0, "waited": 0, "abandoned": 0, "max_queue": 0}
+
+    def acquire(self, on_wait=None, poll=0.5):
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            self.stats["max_queue"] = max(self.stats["max_queue"], len(self._queue))
+        waited = False
+        try:
+            while True:
+                with self._cond:
+                    if self._queue[0] is ticket and self._active < self.max_concurrent:
+                        self._queue.popleft()
+                        self._active += 1
+                        self.stats["admitted"] += 1
+                        self.stats["waited"] += waited
+                        self._cond.notify_all()
+                        return
+                    position = self._queue.index(ticket) + 1
+                # 画面の更新は行列のロックの外で行う
+                waited = True
+                if on_wait:
+                    on_wait(position)
+                with self._cond:
+                    self._cond.wait(poll)
+        except BaseException:
+            with self._cond:
+                if ticket in self._queue:
+                    self._queue.remove(ticket)
+                    self.stats["abandoned"] += 1
+                self._cond.notify_all()
+            raise
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, on_wait=None):
+        self.acquire(on_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self):
+        with self._cond:
+            return {"active": self._active, "waiting": len(self._queue), **self.stats}
+
+
+_gate = None
+_singleton_lock = threading.Lock()  # 最初の呼び出しが重なっても1つだけ作る
+
+
+def get_request_gate():
+    global _gate
+    if _gate is None:
+        with _singleton_lock:
+            if _gate is None:
+                _gate = RequestGate()
+    return _gate
+
+
+def stream_draft(client, theme, model=MODEL, max_chars=MAX_RESPONSE_CHARS, max_seconds=MAX_SECONDS, usage=None):
+    """構成案をストリーミングで生成する
+
+    (途中までの dict, 完了したか) を順に yield し、最後に完成した dict を done=True で返す。
+    上限を超えた場合は GenerationAborted を送出する。
+    usage に dict を渡すと、消費トークン数 (prompt_tokens / completion_tokens) を書き込む。
+    """
+    stream = call_with_retries(lambda: client.chat.completions.create(
+        model=model,
+        messages=build_messages(theme),
+        response_format={"type": "json_object"},
+        stream=True,
+        stream_options={"include_usage": True},
+    ))
+    started = last_parse = time.monotonic()
+    parts, length = [], 0
+    try:
+        for chunk in stream:
+            if usage is not None and getattr(chunk, "usage", None):
+                usage["prompt_tokens"] = chunk.usage.prompt_tokens
+                usage["completion_tokens"] = chunk.usage.completion_tokens
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+            length += len(delta)
+            now = time.monotonic()
+            if length > max_chars or now - started > max_seconds:
+                raise GenerationAborted(f"生成が上限を超えたため中止しました ({length}文字 / {now - started:.0f}秒)")
+            if now - last_parse >= PARSE_INTERVAL:
+                last_parse = now
+                partial = parse_partial_json("".join(parts))
+                if isinstance(partial, dict):
+                    yield partial, False
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    yield json.loads("".join(parts)), True
+
+
+# --- 生成結果のキャッシュ ---
+DRAFT_CACHE_PATH = os.path.join(".cache", "ai_drafts.sqlite3")
+DRAFT_CACHE_TTL = 30 * 24 * 3600  # 秒
+DRAFT_CACHE_MAX_ENTRIES = 5000
+
+
+def normalize_theme(theme):
+    """全角半角・大文字小文字・空白の違いを吸収したテーマ文字列"""
+    return " ".join(unicodedata.normalize("NFKC", theme).lower().split())
+
+
+def draft_cache_key(theme, model=MODEL, prompt_version=PROMPT_VERSION):
+    payload = f"{prompt_version}\0{model}\0{normalize_theme(theme)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DraftCache:
+    """AIの構成案を SQLite に保存するキャッシュ (TTL + 最終利用日時によるLRU削除)
+
+    ヒットした回数と、生成時のトークン数・所要時間を記録しておき、
+    キャッシュで節約できたトークン数・待ち時間を集計できる。
+    """
+
+    def __init__(self, path=DRAFT_CACHE_PATH, ttl=DRAFT_CACHE_TTL, max_entries=DRAFT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS drafts (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                prompt_version INTEGER NOT NULL,
+                theme TEXT NOT NULL,
+                response TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                latency REAL NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS drafts_last_used ON drafts (last_used)")
+        self._conn.commit()
+
+    def get(self, theme, model=MODEL):
+        """キャッシュ済みの構成案 (dict) と生成時の所要時間を返す。無ければ (None, 0)"""
+        key = draft_cache_key(theme, model)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, latency FROM drafts WHERE key = ? AND created_at > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None, 0.0
+            self._conn.execute("UPDATE drafts SET hits = hits + 1, last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0]), row[1]
+
+    def put(self, theme, data, usage=None, latency=0.0, model=MODEL):
+        usage = usage or {}
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO drafts
+                   (key, model, prompt_version, theme, response, prompt_tokens, completion_tokens,
+                    latency, hits, created_at, last_used)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)""",
+                (draft_cache_key(theme, model), model, PROMPT_VERSION, normalize_theme(theme),
+                 json.dumps(data, ensure_ascii=False), usage.get("prompt_tokens", 0),
+                 usage.get("completion_tokens", 0), latency, now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM drafts WHERE created_at <= ?", (now - self.ttl,))
+        self._conn.execute(
+            """DELETE FROM drafts WHERE key IN (
+                   SELECT key FROM drafts ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+            (self.max_entries,),
+        )
+
+    def stats(self):
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT COUNT(*), COALESCE(SUM(hits), 0),
+                          COALESCE(SUM(hits * (prompt_tokens + completion_tokens)), 0),
+                          COALESCE(SUM(hits * latency), 0)
+                   FROM drafts"""
+            ).fetchone()
+        return {"entries": row[0], "hits": row[1], "saved_tokens": row[2], "saved_seconds": round(row[3], 1)}
+
+
+_draft_cache = None
+
+
+def get_draft_cache():
+    global _draft_cache
+    if _draft_cache is None:
+        with _singleton_lock:
+            if _draft_cache is None:
+                _draft_cache = DraftCache()
+    return _draft_cache
@@ -0,0 +1,143 @@
+"""診断ページから届く回答・結果イベントの受け付けと集計
+
+ブラウザからは {"quiz_id": ..., "session": ..., "events": [{"t": "start"}, {"t": "answer", "q": 0, "c": 2},
+{"t": "result", "r": "A"}, ...]} の形でまとめて送られてくる。
+EventBuffer に溜めておき、一定間隔で生イベントをまとめて INSERT し、
+同時にそのバッチ分の集計値 (差分) を quiz_rollups に加算する。
+画面側は生イベントを読まず、quiz_rollups だけを参照する。
+"""
+from collections import defaultdict
+
+import counters
+
+MAX_EVENTS_PER_REQUEST = 100
+MAX_QUESTIONS = 50
+MAX_OPTIONS = 20
+
+
+class InvalidPayload(ValueError):
+    pass
+
+
+def parse_payload(payload):
+    """送られてきた JSON を検証し、quiz_events に入れる行のリストにする"""
+    if not isinstance(payload, dict):
+        raise InvalidPayload("payload must be an object")
+    quiz_id, session = payload.get("quiz_id"), payload.get("session")
+    events = payload.get("events")
+    if not isinstance(quiz_id, str) or not 0 < len(quiz_id) <= 64:
+        raise InvalidPayload("invalid quiz_id")
+    if not isinstance(session, str) or len(session) > 64:
+        raise InvalidPayload("invalid session")
+    if not isinstance(events, list) or not 0 < len(events) <= MAX_EVENTS_PER_REQUEST:
+        raise InvalidPayload("invalid events")
+
+    rows = []
+    for ev in events:
+        if not isinstance(ev, dict):
+            continue
+        kind = ev.get("t")
+        row = {"quiz_id": quiz_id, "session": session, "type": kind, "question": None, "choice": None, "result": None}
+        if kind == "start":
+            pass
+        elif kind == "answer":
+            q, c = ev.get("q"), ev.get("c")
+            if not (isinstance(q, int) and 0 <= q < MAX_QUESTIONS and isinstance(c, int) and 0 <= c < MAX_OPTIONS):
+                continue
+            row.update(question=q, choice=c)
+        elif kind == "result":
+            r = ev.get("r")
+            if not isinstance(r, str) or not 0 < len(r) <= 64:
+                continue
+            row.update(result=r)
+        else:
+            continue
+        rows.append(row)
+    return rows
+
+
+def rollup_deltas(rows):
+    """イベントの行から、quiz_id ごとの集計値の差分を作る
+
+    starts: 開始数 / completions: 結果表示数 / results: {結果タイプ: 件数}
+    answered: {質問番号: 回答数} (質問ごとの離脱は answered の差で求める)
+    """
+    rollups = {}
+    for row in rows:
+        r = rollups.get(row["quiz_id"])
+        if r is None:
+            r = rollups[row["quiz_id"]] = {
+                "quiz_id": row["quiz_id"], "starts": 0, "completions": 0,
+                "results": defaultdict(int), "answered": defaultdict(int),
+            }
+        if row["type"] == "start":
+            r["starts"] += 1
+        elif row["type"] == "answer":
+            r["answered"][str(row["question"])] += 1
+        elif row["type"] == "result":
+            r["completions"] += 1
+            r["results"][row["result"]] += 1
+    return [{**r, "results": dict(r["results"]), "answered": dict(r["answered"])} for r in rollups.values()]
+
+
+def summarize(rollup, num_questions=None):
+    """quiz_rollups の1行を画面表示用にまとめる"""
+    if not rollup:
+        return None
+    starts = rollup.get("starts") or 0
+    answered = {int(k): v for k, v in (rollup.get("answered") or {}).items()}
+    n = num_questions if num_questions is not None else (max(answered) + 1 if answered else 0)
+    reached = [starts] + [answered.get(q, 0) for q in range(n)]
+    return {
+        "starts": starts,
+        "completions": rollup.get("completions") or 0,
+        "completion_rate": (rollup.get("completions") or 0) / starts if starts else 0.0,
+        "results": rollup.get("results") or {},
+        # 質問ごとに、その質問で離脱した人数
+        "drop_off": {q + 1: max(reached[q] - reached[q + 1], 0) for q in range(n)},
+    }
+
+
+class EventBuffer(counters.WriteBehindBuffer):
+    """イベントをメモリに溜め、interval 秒ごと (または max_pending 件) にまとめて書き込む
+
+    flush_fn(rows, deltas) には、生イベントの行と rollup_deltas() の結果が渡される。
+    行の INSERT と集計の加算は flush_fn の中で1つのトランザクションにすること
+    (片方だけ反映されたバッチを再試行すると、イベントが二重に記録される)。
+    """
+
+    thread_name = "event-buffer"
+
+    def __init__(self, flush_fn, interval=10.0, max_pending=2000, max_buffered=50000, max_retries=3):
+        super().__init__(interval, max_pending, max_retries)
+        self._flush_fn = flush_fn
+        self.max_buffered = max_buffered
+        self._rows = []
+        self.stats["received"] = 0
+
+    def add(self, rows):
+        with self._lock:
+            room = self.max_buffered - len(self._rows)
+            accepted = rows[:max(room, 0)]
+            self._rows.extend(accepted)
+            self.stats["received"] += len(accepted)
+            self.stats["dropped"] += len(rows) - len(accepted)
+            full = len(self._rows) >= self.max_pending
+        if full:
+            self._notify_full()
+        return len(accepted)
+
+    def _take(self):
+        if not self._rows:
+            return None
+        rows, self._rows = self._rows, []
+        return rows
+
+    def _write(self, rows):
+        self._flush_fn(rows, rollup_deltas(rows))
+
+    def _restore(self, rows):
+        # 書き込めなかった分は戻して次回に回す (上限を超える分は捨てる)
+        room = self.max_buffered - len(self._rows)
+        self._rows[:0] = rows[:max(room, 0)]
+        self.stats["dropped"] += len(rows) - max(min(room, len(rows)), 0)
@@ -1,15 +1,17 @@
 import streamlit as st
-import json
-import openai
 import os
 import time
-import stripe
 import streamlit.components.v1 as components
-import urllib.parse
 import math  # ページネーション計算用に追加
 
 import styles
 import logic
+import ai
+import analytics
+import metrics
+
+# この再実行 (rerun) の処理時間の内訳を記録する (管理者パネルで表示)
+metrics.start_trace()
 
 # 日本語文字化け防止
 os.environ["PYTHONIOENCODING"] = "utf-8"
@@ -17,18 +19,19 @@ os.environ["PYTHONIOENCODING"] = "utf-8"
 # ページ設定
 st.set_page_config(page_title="診断クイズメーカー", page_icon="💎", layout="wide")
 
-# ブラウザの「翻訳しますか？」ポップアップを抑制するスクリプト
-components.html("""
-    <script>
-        window.parent.document.documentElement.lang = 'ja';
-    </script>
-""", height=0)
-
 # --- 初期設定 ---
-if "stripe" in st.secrets:
-    stripe.api_key = st.secrets["stripe"]["api_key"]
-
-supabase = logic.init_supabase()
+repo = logic.init_storage()
+if repo:
+    logic.get_trend_rebaser(repo)
+
+def setup_full_app():
+    """ポータル・エディタ・決済画面用の初期化 (プレイ画面では行わない)"""
+    # ブラウザの「翻訳しますか？」ポップアップを抑制するスクリプト
+    components.html("""
+        <script>
+            window.parent.document.documentElement.lang = 'ja';
+        </script>
+    """, height=0)
 
 def init_state(key, val):
     if key not in st.session_state:
@@ -43,7 +46,11 @@ init_state('current_page', 1)
 init_state('prev_sort_order', '新着順') # 並べ替え変更検知用
 
 AI_LIMIT = 5
+AI_DRAFT_FIELDS = 1 + 3 + 5  # タイトル + 結果3つ + 質問5問 (進捗表示用)
+
 ITEMS_PER_PAGE = 15  # 1ページあたりの表示数
+PAGINATION_MODE = "keyset"  # "keyset" (カーソル方式) / "offset" (従来の range 指定)
+COUNT_MODE = "cached"  # 総件数: "exact" / "planned" / "estimated" / "cached"
 
 query_params = st.query_params
 quiz_id = query_params.get("id", None)
@@ -59,23 +66,29 @@ if query_params.get("admin") == "secret":
 # ==========================================
 
 # --- 🅰️ プレイ画面 (Web公開) ---
+# 表示までの時間を優先し、最小限のCSSだけを読み込む
 if quiz_id:
-    styles.apply_portal_style()
-    if not supabase:
+    styles.apply_play_style()
+    if not repo:
         st.stop()
     try:
         if f"viewed_{quiz_id}" not in st.session_state:
-            logic.increment_views(supabase, quiz_id)
+            logic.increment_views(repo, quiz_id)
             st.session_state[f"viewed_{quiz_id}"] = True
 
-        res = supabase.table("quizzes").select("*").eq("id", quiz_id).execute()
-        if not res.data:
+        quiz = logic.get_quiz(repo, quiz_id)
+        if not quiz:
             st.error("診断が見つかりません。")
             st.markdown(styles.get_custom_button_html("/", "🏠 トップページに戻る", "blue"), unsafe_allow_html=True)
             st.stop()
         
-        data = res.data[0]['content']
-        html_content = logic.generate_html_content(data)
+        data = quiz['content']
+        # 回答データの送信先 (play_server の /events など) が設定されていれば計測する
+        html_content = logic.generate_html_content(
+            data, standalone=True, events_url=logic.analytics_events_url(), quiz_id=quiz_id,
+            digest=quiz.get('content_hash')
+        )
+        metrics.HTML_PAYLOAD_BYTES.observe(len(html_content.encode("utf-8")), "play")
         components.html(html_content, height=800, scrolling=True)
         
         c_like, c_back = st.columns([1, 1])
@@ -85,7 +98,7 @@ if quiz_id:
                 st.button("❤️ いいね済み", disabled=True, use_container_width=True)
             else:
                 if st.button("🤍 この診断に「いいね」する", type="secondary", use_container_width=True):
-                    logic.increment_likes(supabase, quiz_id)
+                    logic.increment_likes(repo, quiz_id)
                     st.session_state[liked_key] = True
                     st.balloons()
                     st.rerun()
@@ -93,23 +106,41 @@ if quiz_id:
         with c_back:
             st.markdown(styles.get_custom_button_html("/", "🏠 ポータルトップへ戻る", "blue", target="_self"), unsafe_allow_html=True)
 
+        if st.session_state.is_admin:
+            with st.expander("📈 回答データ (管理者)"):
+                summary = analytics.summarize(logic.get_quiz_rollup(repo, quiz_id), len(data.get('questions', [])))
+                if not summary or not summary['starts']:
+                    st.caption("まだ回答データがありません。")
+                else:
+                    m1, m2, m3 = st.columns(3)
+                    m1.metric("開始", summary['starts'])
+                    m2.metric("完了", summary['completions'])
+                    m3.metric("完了率", f"{summary['completion_rate']:.0%}")
+                    st.caption("結果の分布")
+                    st.bar_chart({data.get('results', {}).get(k, {}).get('title', k): v for k, v in summary['results'].items()})
+                    st.caption("質問ごとの離脱数")
+                    st.bar_chart({f"Q{q}": n for q, n in summary['drop_off'].items()})
+
     except Exception as e:
         st.error(e)
 
 # --- 🅱️ 決済完了画面 ---
 elif session_id:
+    setup_full_app()
     styles.apply_portal_style()
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
+        with metrics.timed("stripe.session_retrieve"):
+            session = logic.get_stripe().checkout.Session.retrieve(session_id)
         if session.payment_status == 'paid':
             paid_id = session.metadata.get('quiz_id')
-            res = supabase.table("quizzes").select("*").eq("id", paid_id).execute()
-            if res.data:
-                data = res.data[0]['content']
+            quiz = logic.get_quiz(repo, paid_id)
+            if quiz:
+                data = quiz['content']
                 st.balloons()
                 st.success("✅ お支払いが完了しました！")
                 
-                final_html = logic.generate_html_content(data)
+                # ダウンロード版はCDNを使わない単体HTML (オフラインでも動作)
+                final_html = logic.generate_html_content(data, standalone=True)
                 st.download_button("📥 HTMLをダウンロード", final_html, "diagnosis.html", "text/html", type="primary")
                 
                 st.markdown(styles.get_custom_button_html("/", "トップページに戻る", "blue", target="_self"), unsafe_allow_html=True)
@@ -119,6 +150,7 @@ elif session_id:
 
 # --- 🆑 ポータル & 作成画面 ---
 else:
+    setup_full_app()
     # 1. ポータルトップ
     if st.session_state.page_mode == 'home':
         styles.apply_portal_style()
@@ -127,7 +159,7 @@ else:
         with c1:
             st.markdown("### 💎 診断クイズメーカー")
         with c2:
-            st.text_input("search", label_visibility="collapsed", placeholder="🔍 キーワード検索...")
+            search_query = st.text_input("search", key="search_query", label_visibility="collapsed", placeholder="🔍 キーワード検索...").strip()
         st.write("") 
 
         st.markdown(styles.HERO_HTML, unsafe_allow_html=True)
@@ -139,54 +171,46 @@ else:
         st.markdown('</div><br>', unsafe_allow_html=True)
 
         # --- 並べ替え機能 ---
-        st.markdown("### 📚 新着の診断")
-        if supabase:
-            sort_col1, sort_col2 = st.columns([1, 4])
-            with sort_col1:
-                sort_order = st.selectbox(
-                    "並べ替え", 
-                    ["新着順", "閲覧数順", "いいね順"], 
-                    label_visibility="collapsed"
-                )
-            
-            # 並べ替えが変わったらページを1に戻す
-            if sort_order != st.session_state.prev_sort_order:
-                st.session_state.current_page = 1
-                st.session_state.prev_sort_order = sort_order
-                st.rerun()
-            
-            # クエリの構築 (count="exact"で総数を取得)
-            query = supabase.table("quizzes").select("*", count="exact").eq("is_public", True)
+        st.markdown(f"### 🔍 「{search_query}」の検索結果" if search_query else "### 📚 新着の診断")
+        if repo:
+            if search_query:
+                # 検索結果は関連度順の上位だけを1ページで表示する
+                rows = logic.search_quizzes(repo, search_query)
+                page, start, end = 1, 0, len(rows) - 1
+                total_count, total_pages = len(rows), 1
+            else:
+                sort_col1, sort_col2 = st.columns([1, 4])
+                with sort_col1:
+                    sort_order = st.selectbox(
+                        "並べ替え", 
+                        list(logic.PORTAL_SORT_COLUMNS), 
+                        label_visibility="collapsed"
+                    )
             
-            if sort_order == "新着順":
-                query = query.order("created_at", desc=True)
-            elif sort_order == "閲覧数順":
-                query = query.order("views", desc=True)
-            elif sort_order == "いいね順":
-                query = query.order("likes", desc=True)
+                # 並べ替えが変わったらページを1に戻す
+                if sort_order != st.session_state.prev_sort_order:
+                    st.session_state.current_page = 1
+                    st.session_state.prev_sort_order = sort_order
+                    st.rerun()
             
-            # ページネーション計算
-            page = st.session_state.current_page
-            start = (page - 1) * ITEMS_PER_PAGE
-            end = start + ITEMS_PER_PAGE - 1
+                # ページネーション計算
+                page = st.session_state.current_page
+                start = (page - 1) * ITEMS_PER_PAGE
+                end = start + ITEMS_PER_PAGE - 1
             
-            # データ取得 (.rangeを使用)
-            res = query.range(start, end).execute()
-            total_count = res.count if res.count is not None else 0
-            total_pages = math.ceil(total_count / ITEMS_PER_PAGE)
+                # データ取得 (全セッション共通のスナップショットから。期限切れは裏で更新)
+                snapshot = logic.get_portal_page(
+                    repo, sort_order, page, ITEMS_PER_PAGE, COUNT_MODE, keyset=(PAGINATION_MODE == "keyset")
+                )
+                rows = snapshot["rows"]
+                total_count = snapshot["total_count"]
+                total_pages = math.ceil(total_count / ITEMS_PER_PAGE)
 
-            if res.data:
+            if rows:
                 cols = st.columns(3)
-                for i, q in enumerate(res.data):
+                for i, q in enumerate(rows):
                     with cols[i % 3]:
-                        content = q.get('content', {})
-                        keyword = content.get('image_keyword', 'abstract')
-                        
-                        # 日本語キーワード対応
-                        encoded_keyword = urllib.parse.quote(keyword)
-                        
-                        seed = q['id'][-4:] 
-                        img_url = f"https://image.pollinations.ai/prompt/{encoded_keyword}%20{seed}?width=350&height=180&nologo=true"
+                        img_url = logic.card_image_url(q)
                         
                         base = "https://shindan-quiz-maker.streamlit.app"
                         link_url = f"{base}/?id={q['id']}"
@@ -198,10 +222,11 @@ else:
                             st.markdown(
                                 styles.get_card_content_html(
                                     q.get('title','無題'), 
-                                    content.get('intro_text',''), 
+                                    q.get('summary') or '', 
                                     img_url, 
                                     views, 
-                                    likes
+                                    likes,
+                                    logic.card_image_sources(q)
                                 ), 
                                 unsafe_allow_html=True
                             )
@@ -212,7 +237,11 @@ else:
                             )
                             
                             if st.button("⚡ コピーして作る", key=f"copy_{q['id']}", use_container_width=True):
-                                content = q['content']
+                                # 一覧では content を取得していないので、ここで初めて読み込む
+                                content = logic.get_quiz_content(repo, q['id'])
+                                if content is None:
+                                    st.error("診断データの取得に失敗しました")
+                                    st.stop()
                                 st.session_state['page_title'] = content.get('page_title', '')
                                 st.session_state['main_heading'] = content.get('main_heading', '')
                                 st.session_state['intro_text'] = content.get('intro_text', '')
@@ -246,7 +275,7 @@ else:
                             if st.session_state.is_admin:
                                 st.markdown('<div class="delete-btn">', unsafe_allow_html=True)
                                 if st.button("🗑️ 削除", key=f"del_{q['id']}"):
-                                    if logic.delete_quiz(supabase, q['id']):
+                                    if logic.delete_quiz(repo, q['id']):
                                         st.toast("削除しました")
                                         time.sleep(1)
                                         st.rerun()
@@ -301,7 +330,21 @@ else:
                     st.caption(f"全 {total_count} 件中 {start + 1} - {min(end + 1, total_count)} 件を表示")
 
             else:
-                st.info("まだ投稿がありません")
+                st.info("該当する診断が見つかりませんでした" if search_query else "まだ投稿がありません")
+
+            if st.session_state.is_admin:
+                with st.expander("📊 キャッシュ統計 (管理者)"):
+                    st.json({**logic.cache_stats(), "storage": repo.backend, "counters": logic.get_counter_buffer(repo).stats,
+                             "trend_rebaser": logic.get_trend_rebaser(repo).stats})
+                with st.expander("🐢 起動時間レポート (管理者)"):
+                    st.caption("このプロセスで遅延読み込みしたSDKの読み込み時間 (秒)")
+                    st.json(logic.IMPORT_TIMINGS)
+                    if st.button("python -X importtime で計測する"):
+                        report = logic.import_time_report()
+                        st.dataframe(
+                            [{"module": m, "self_ms": s, "cumulative_ms": c} for m, s, c in report],
+                            use_container_width=True,
+                        )
 
     # 2. 作成エディタ
     elif st.session_state.page_mode == 'create':
@@ -321,6 +364,9 @@ else:
                 st.stop()
             
             st.header("🧠 AIアシスタント")
+            if st.session_state.is_admin:
+                st.caption(f"構成案キャッシュ: {ai.get_draft_cache().stats()}")
+                st.caption(f"AIリクエスト待ち行列: {ai.get_request_gate().snapshot()}")
             
             theme_placeholder = """【良い診断を作るためのヒント】
 1. ターゲット：誰に向けた診断か？ (例: 30代の婚活女性、フリーランス、猫好き)
@@ -332,69 +378,49 @@ else:
 辛口かつ論理的なアドバイスで、背中を押してほしい。"""
 
             theme = st.text_area("テーマ・詳細設定", height=300, placeholder=theme_placeholder)
-            st.caption("※AIの文章作成には10秒〜30秒ほどかかります。")
+            st.caption("※AIの文章作成には10秒〜30秒ほどかかります。届いた内容から順に反映されます。")
+            st.caption(f"AI作成の残り回数: {max(AI_LIMIT - st.session_state.ai_count, 0)} / {AI_LIMIT}")
+            
+            regenerate = st.checkbox("キャッシュを使わず再生成する", value=False,
+                                     help="同じテーマの構成案が保存されている場合は、通常それを即座に表示します。")
             
             if st.button("AIで構成案を作成", type="primary"):
+                draft_cache = ai.get_draft_cache()
+                cached, cached_latency = (None, 0.0) if regenerate or not theme else draft_cache.get(theme)
                 if not theme:
                     st.warning("テーマを入力してください")
+                elif cached is not None:
+                    logic.apply_ai_draft(cached)
+                    st.success(f"⚡ 保存済みの構成案を表示しました (生成時 {cached_latency:.0f}秒)")
+                    time.sleep(0.5)
+                    st.rerun()
+                elif st.session_state.ai_count >= AI_LIMIT and not st.session_state.is_admin:
+                    st.error(f"AIの利用回数の上限 ({AI_LIMIT}回) に達しました")
                 else:
+                    msg = st.empty()
+                    progress = st.progress(0.0)
+                    preview = st.empty()
+                    # 生成中にこのボタンを押すと再実行になり、ストリーミングはそこで止まる
+                    st.button("⏹ 生成を中止", key="ai_cancel")
                     try:
-                        msg = st.empty()
-                        msg.info("AIが執筆中... (最大30秒かかります)")
-                        client = openai.OpenAI(api_key=api_key)
-                        
-                        # 日本語キーワードを強制するプロンプトに変更
-                        prompt = f"""
-                        あなたはプロの診断作家です。テーマ: {theme}
-                        【絶対厳守】
-                        1. 質問は「必ず5問」作成すること。
-                        2. 選択肢は「必ず4つ」作成すること。
-                        3. 結果パターンは「必ず3つ（A, B, C）」作成すること。
-                        4. JSONのみ出力
-                        
-                        【画像キーワードについて】
-                        image_keywordは、必ず「英単語1語」で出力してください。（例: cat, ocean, future, business）
-                        
-                        出力JSON:
-                        {{
-                            "page_title": "", "main_heading": "", "intro_text": "", "image_keyword": "英単語1語",
-                            "results": {{ "A": {{ "title": "", "desc": "600字", "btn": "", "link":"" }}, "B": {{...}}, "C": {{...}} }},
-                            "questions": [ {{ "question": "", "answers": [ {{ "text": "", "type": "A" }}, {{ "text": "", "type": "B" }}, {{ "text": "", "type": "C" }}, {{ "text": "", "type": "A" }} ] }} ]
-                        }}
-                        """
-                        res = client.chat.completions.create(
-                            model="gpt-4o-mini", 
-                            messages=[{"role":"system","content":"Output JSON only"}, {"role":"user","content":prompt}], 
-                            response_format={"type":"json_object"}
-                        )
-                        data = json.loads(res.choices[0].message.content)
-                        
-                        st.session_state['page_title'] = data.get('page_title','')
-                        st.session_state['main_heading'] = data.get('main_heading','')
-                        st.session_state['intro_text'] = data.get('intro_text','')
-                        st.session_state['image_keyword'] = data.get('image_keyword', 'random')
-                        
-                        if 'results' in data:
-                            for t in ['A','B','C']:
-                                if t in data['results']:
-                                    r = data['results'][t]
-                                    st.session_state[f'res_title_{t}'] = r.get('title','')
-                                    st.session_state[f'res_desc_{t}'] = r.get('desc','')
-                                    st.session_state[f'res_btn_{t}'] = r.get('btn','')
-                                    st.session_state[f'res_link_{t}'] = r.get('link','')
-                        
-                        if 'questions' in data:
-                            for i,q in enumerate(data['questions']):
-                                if i>=5: break
-                                st.session_state[f'q_text_{i+1}'] = q.get('question','')
-                                for j,a in enumerate(q.get('answers',[])):
-                                    if j>=4: break
-                                    st.session_state[f'q{i+1}_a{j+1}_text'] = a.get('text','')
-                                    st.session_state[f'q{i+1}_a{j+1}_type'] = a.get('type','A')
-                                    
+                        client = logic.get_openai_client(api_key)
+                        usage = {}
+                        # 混雑時は先着順に待つ (同時リクエスト数はプロセス全体で制限)
+                        with ai.get_request_gate().slot(on_wait=lambda pos: msg.info(f"混雑しています... 順番待ち {pos} 番目")):
+                            msg.info("AIが執筆中... 届いた内容から順に反映します")
+                            started = time.time()
+                            st.session_state.ai_count += 1
+                            with metrics.timed("openai.stream"):
+                                for data, done in ai.stream_draft(client, theme, usage=usage):
+                                    filled = logic.apply_ai_draft(data)
+                                    progress.progress(min(filled / AI_DRAFT_FIELDS, 1.0))
+                                    preview.caption(f"📝 {data.get('main_heading') or data.get('page_title') or '...'}")
+                        draft_cache.put(theme, data, usage, time.time() - started)
                         msg.success("完了！")
                         time.sleep(0.5)
                         st.rerun()
+                    except ai.GenerationAborted as e:
+                        msg.warning(f"{e} (途中までの内容は反映済みです)")
                     except Exception as e:
                         st.error(e)
 
@@ -485,6 +511,26 @@ else:
             }
         
         if st.session_state.draft_data:
+            # --- 結果バランスの確認 (全ての回答パターンで採点) ---
+            st.markdown("---")
+            st.subheader("⚖️ 結果バランスの確認")
+            scoring = logic.get_scoring()
+            sim = scoring.simulate(scoring.compile_quiz(st.session_state.draft_data))
+            if sim is None:
+                st.caption("質問と結果を入力すると、結果の出やすさを確認できます。")
+            else:
+                method = "全パターン" if sim['exhaustive'] else "無作為抽出"
+                st.caption(f"{method} {sim['combinations']:,} 通りの回答で、どの結果になるかを計算しました。")
+                bal_cols = st.columns(len(sim['shares']) + 1)
+                for col, (t, share) in zip(bal_cols, sim['shares'].items()):
+                    col.metric(f"Type {t}", f"{share:.0%}")
+                    col.progress(min(share, 1.0))
+                bal_cols[-1].metric("同点になる割合", f"{sim['tie_rate']:.0%}")
+                for t in sim['unreachable']:
+                    st.error(f"Type {t} の結果には、どう回答しても到達しません。選択肢の加点先を見直してください。")
+                for t in sim['dominant']:
+                    st.warning(f"Type {t} に結果が偏っています ({sim['shares'][t]:.0%})。加点先を分散させましょう。")
+
             st.markdown("---")
             st.subheader("5. 公開・販売設定")
             st.info("URL発行（無料）はポータルサイトに自動掲載されます。\n診断クイズファイルのダウンロード（有料）はポータル掲載の有無を選択できます。")
@@ -514,16 +560,13 @@ else:
                 else:
                     try:
                         is_p = True if sub_free else is_pub
-                        res = supabase.table("quizzes").insert({
-                            "email":email, "title":draft['main_heading'], "content":draft, 
-                            "is_public":is_p, "price":price
-                        }).execute()
-                        
-                        new_id = res.data[0]['id']
+                        new_id = logic.insert_quiz(repo, logic.build_quiz_record(email, draft, is_p, price))['id']
                         base = "https://shindan-quiz-maker.streamlit.app"
                         
                         if sub_free:
-                            if logic.send_email(email, f"{base}/?id={new_id}", draft['main_heading']):
+                            quiz_url = f"{base}/?id={new_id}"
+                            # メールは送信キューに入れるだけなので、ここでは待たない
+                            if logic.send_email(email, quiz_url, draft['main_heading']):
                                 st.success("公開しました！メールを確認してください")
                                 st.balloons()
                                 time.sleep(2)
@@ -531,18 +574,35 @@ else:
                                 st.session_state.page_mode='home'
                                 st.rerun()
                             else:
-                                st.error("メール送信失敗")
+                                # 診断は登録済みなので、URLをその場で表示する
+                                st.warning("公開しました。メールの送信予約に失敗したため、以下のURLを控えてください")
+                                st.code(quiz_url)
                         
                         if sub_paid:
-                            sess = stripe.checkout.Session.create(
-                                payment_method_types=['card'],
-                                line_items=[{'price_data':{'currency':'jpy','product_data':{'name':f"{draft['main_heading']}"},'unit_amount':price},'quantity':1}],
-                                mode='payment',
-                                success_url=f"{base}/?session_id={{CHECKOUT_SESSION_ID}}",
-                                cancel_url=f"{base}/",
-                                metadata={'quiz_id':new_id}
-                            )
+                            with metrics.timed("stripe.session_create"):
+                                sess = logic.get_stripe().checkout.Session.create(
+                                    payment_method_types=['card'],
+                                    line_items=[{'price_data':{'currency':'jpy','product_data':{'name':f"{draft['main_heading']}"},'unit_amount':price},'quantity':1}],
+                                    mode='payment',
+                                    success_url=f"{base}/?session_id={{CHECKOUT_SESSION_ID}}",
+                                    cancel_url=f"{base}/",
+                                    metadata={'quiz_id':new_id}
+                                )
                             st.link_button("決済へ進む", sess.url, type="primary")
                             
                     except Exception as e:
                         st.error(f"保存エラー: {e}")
+
+# --- ⏱ 処理時間 (管理者) ---
+if st.session_state.is_admin:
+    entries, total = metrics.trace()
+    with st.expander(f"⏱ この画面の処理時間 {total * 1000:.0f} ms (管理者)"):
+        if entries:
+            st.dataframe(
+                [{"段階": stage, "ms": round(seconds * 1000, 2), "成功": ok} for stage, seconds, ok in entries],
+                use_container_width=True,
+            )
+        else:
+            st.caption("この再実行では計測対象の処理はありませんでした (キャッシュから表示)")
+        if st.checkbox("プロセス全体の集計 (Prometheus 形式) を表示"):
+            st.code(metrics.render(), language="text")
@@ -0,0 +1,355 @@
+"""性能のベンチマーク (外部サービスはすべてローカルの代替で動かす)
+
+    python bench.py                     # 全件を計測して .benchmarks/<commit>.json に保存
+    python bench.py render listing      # 名前に含まれる文字列で絞り込む
+    python bench.py --compare .benchmarks/abc1234.json   # 以前の結果と比較する
+
+計測対象:
+    render.*   generate_html_content (small / large / pathological、キャッシュなし・あり)
+    listing.*  ポータル一覧 (SQLite に --quizzes 件を登録し、キーセット / OFFSET / 件数)
+    publish.*  診断の登録 + 送信キューへの投入、送信スレッドでの送信、有料公開の Checkout 作成・確認
+    ai.*       AI構成案のストリーミング受信とフォームへの反映
+    thumbs.*   カード画像の縮小・保存 (元画像はローカルの代替)
+    search.*   キーワード検索 (--quizzes 件の索引で、1文字の語・ほぼ全件に含まれる語・AND 検索)
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import ai
+import fakes
+import logic
+import mailer
+import search
+import storage
+import thumbnails
+
+RESULTS_DIR = ".benchmarks"
+REGRESSION_THRESHOLD = 1.10  # 前回比でこれ以上遅くなったら印を付ける
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """setup 関数を登録する。setup は計測する関数 (引数なし) を返す"""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+# --- 描画 ---
+def _render_bench(size, standalone, cached):
+    def setup(ctx):
+        content = fakes.make_quiz(**fakes.QUIZ_SIZES[size])
+        logic.RENDER_CACHE.clear()
+        logic.generate_html_content(content, standalone=standalone)
+        if cached:
+            # プレイ画面・play_server と同じく、get_quiz の行の計算済みハッシュを渡す
+            digest = logic.content_hash(content)
+            return lambda: logic.generate_html_content(content, standalone=standalone, digest=digest)
+
+        def run():
+            logic.RENDER_CACHE.clear()
+            logic.generate_html_content(content, standalone=standalone)
+        return run
+    return setup
+
+
+for _size in fakes.QUIZ_SIZES:
+    for _standalone in (False, True):
+        _mode = "standalone" if _standalone else "cdn"
+        benchmark(f"render.{_size}.{_mode}")(_render_bench(_size, _standalone, cached=False))
+    benchmark(f"render.{_size}.cached")(_render_bench(_size, True, cached=True))
+
+
+# --- ポータル一覧 ---
+def _listing_repo(ctx):
+    if "repo" not in ctx:
+        ctx["repo"] = storage.SQLiteRepository(os.path.join(ctx["tmp"], "bench.sqlite3"))
+        fakes.seed_repository(ctx["repo"], ctx["quizzes"])
+    return ctx["repo"]
+
+
+def _deep_page(ctx, per_page=15):
+    return max(1, ctx["quizzes"] * 9 // 10 // per_page)
+
+
+@benchmark("listing.first_page")
+def _(ctx):
+    repo = _listing_repo(ctx)
+    return lambda: logic.fetch_portal_page(repo, "新着順", 1, 15)
+
+
+@benchmark("listing.deep_page.offset")
+def _(ctx):
+    repo, page = _listing_repo(ctx), _deep_page(ctx)
+    return lambda: logic.fetch_portal_page(repo, "閲覧数順", page, 15)
+
+
+@benchmark("listing.deep_page.keyset")
+def _(ctx):
+    repo, page = _listing_repo(ctx), _deep_page(ctx)
+    cursors = {}
+    for p in range(1, page):
+        logic.fetch_portal_page(repo, "閲覧数順", p, 15, cursors)
+    return lambda: logic.fetch_portal_page(repo, "閲覧数順", page, 15, dict(cursors))
+
+
+@benchmark("listing.trending.first_page")
+def _(ctx):
+    repo = _listing_repo(ctx)
+    return lambda: logic.fetch_portal_page(repo, "トレンド順", 1, 15)
+
+
+@benchmark("listing.trending.increment")
+def _(ctx):
+    # 閲覧数のまとめ書き込み1回分 (trend_score の加算を含む)
+    repo = _listing_repo(ctx)
+    ids = [r["id"] for r in repo.list_page("created_at", 500, columns="id")]
+    return lambda: repo.increment_counters([{"id": i, "views": 1, "likes": 0} for i in ids])
+
+
+@benchmark("listing.count")
+def _(ctx):
+    repo = _listing_repo(ctx)
+    return lambda: logic.count_public_quizzes(repo, "exact")
+
+
+@benchmark("listing.portal_page.snapshot")
+def _(ctx):
+    repo = _listing_repo(ctx)
+    logic.PORTAL_SNAPSHOTS.clear()
+    logic.get_portal_page(repo, "いいね順", 1, 15)
+    return lambda: logic.get_portal_page(repo, "いいね順", 1, 15)
+
+
+# --- 公開 (登録 + メール) ---
+def _mailer(ctx, name):
+    return mailer.Mailer(
+        "bench@example.com", fakes.FakeSMTPConnection(),
+        mailer.Outbox(os.path.join(ctx["tmp"], f"{name}.sqlite3")),
+    )
+
+
+@benchmark("publish.insert_and_enqueue")
+def _(ctx):
+    repo = storage.SQLiteRepository(os.path.join(ctx["tmp"], "publish.sqlite3"))
+    outbox_mailer = _mailer(ctx, "outbox_publish")
+    draft = fakes.make_quiz()
+
+    def run():
+        row = logic.insert_quiz(repo, logic.build_quiz_record("author@example.com", draft, True, 0))
+        outbox_mailer.enqueue("author@example.com", "【診断クイズメーカー】URL発行のお知らせ", f"/?id={row['id']}")
+    return run
+
+
+@benchmark("publish.paid_checkout")
+def _(ctx):
+    # 有料公開: 登録 + Checkout の作成、決済完了画面での確認 + ダウンロード用HTMLの生成
+    repo = storage.SQLiteRepository(os.path.join(ctx["tmp"], "publish_paid.sqlite3"))
+    stripe = fakes.FakeStripe()
+    draft = fakes.make_quiz()
+
+    def run():
+        row = logic.insert_quiz(repo, logic.build_quiz_record("author@example.com", draft, True, 500))
+        sess = stripe.checkout.Session.create(
+            payment_method_types=['card'],
+            line_items=[{'price_data': {'currency': 'jpy', 'product_data': {'name': draft['main_heading']},
+                                        'unit_amount': 500}, 'quantity': 1}],
+            mode='payment',
+            success_url="http://localhost:8501/?session_id={CHECKOUT_SESSION_ID}",
+            cancel_url="http://localhost:8501/",
+            metadata={'quiz_id': row['id']},
+        )
+        paid = stripe.checkout.Session.retrieve(sess.id)
+        quiz = logic.get_quiz(repo, paid.metadata['quiz_id'])
+        logic.generate_html_content(quiz['content'], standalone=True)
+    return run
+
+
+@benchmark("publish.send_queued")
+def _(ctx):
+    outbox_mailer = _mailer(ctx, "outbox_send")
+
+    def run():
+        outbox_mailer.enqueue("author@example.com", "件名", "本文")
+        outbox_mailer.run_once()
+    return run
+
+
+# --- AI構成案 ---
+def _ingest(client, parse_interval):
+    def run():
+        saved, ai.PARSE_INTERVAL = ai.PARSE_INTERVAL, parse_interval
+        try:
+            state = {}
+            for data, done in ai.stream_draft(client, "恋愛タイプ診断"):
+                logic.apply_ai_draft(data, state)
+            return state
+        finally:
+            ai.PARSE_INTERVAL = saved
+    return run
+
+
+@benchmark("ai.ingest")
+def _(ctx):
+    return _ingest(fakes.FakeOpenAI(), ai.PARSE_INTERVAL)
+
+
+@benchmark("ai.ingest.parse_every_chunk")
+def _(ctx):
+    # 途中経過をチャンクごとに解析した場合 (PARSE_INTERVAL の間引きがない最悪の場合)
+    return _ingest(fakes.FakeOpenAI(), 0.0)
+
+
+# --- カード画像 ---
+@benchmark("thumbs.generate")
+def _(ctx):
+    store = thumbnails.ThumbnailStore(os.path.join(ctx["tmp"], "thumbs"))
+    worker = thumbnails.ThumbnailWorker(store, fetch_fn=fakes.FakeImageSource())
+    counter = itertools.count()
+    # 毎回別の診断として生成させる (作成済みの判定で飛ばされないように)
+    return lambda: worker.generate({"id": f"bench-{next(counter):08d}", "image_keyword": "abstract"})
+
+
+# --- 検索 ---
+def _search_index(ctx):
+    if "search_index" not in ctx:
+        # 診断ごとに本文を変えて入れる (同じ本文だと、どの語も全件に一致してしまう)
+        ctx["search_index"] = index = search.SearchIndex(os.path.join(ctx["tmp"], "bench_search.sqlite3"))
+        index.rebuild({"id": f"bench-{i:08d}", "title": f"診断 {i}", "content": fakes.make_quiz(seed=i),
+                       "is_public": True, "views": i % 1000, "likes": i % 50} for i in range(ctx["quizzes"]))
+    return ctx["search_index"]
+
+
+@benchmark("search.one_char")
+def _(ctx):
+    index = _search_index(ctx)
+    return lambda: index.search("診")
+
+
+@benchmark("search.common_term")
+def _(ctx):
+    index = _search_index(ctx)
+    return lambda: index.search("診断")
+
+
+@benchmark("search.and_terms")
+def _(ctx):
+    index = _search_index(ctx)
+    return lambda: index.search("結果 あ")
+
+
+# --- 計測 ---
+def measure(fn, repeat=5, min_time=0.2):
+    """1回あたりの秒数。min_time 秒以上かかる回数をまとめて1組とし、repeat 組計測する"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed * 2 >= min_time else 10
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return {
+        "min": min(samples), "median": statistics.median(samples), "mean": statistics.fmean(samples),
+        "number": number, "repeat": repeat,
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def compare(results, baseline):
+    """(名前, 前回の中央値, 今回の中央値, 比) のリスト"""
+    rows = []
+    for name, r in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old:
+            rows.append((name, old["median"], r["median"], r["median"] / old["median"]))
+    return rows
+
+
+def _fmt(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ベンチマークを実行して結果をJSONに保存する")
+    parser.add_argument("filters", nargs="*", help="名前にこれを含むものだけ実行")
+    parser.add_argument("--quizzes", type=int, default=5000, help="一覧の計測で登録する診断の件数")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--out", default=None, help="結果の保存先 (省略時は .benchmarks/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="比較する以前の結果ファイル")
+    args = parser.parse_args(argv)
+
+    names = [n for n in BENCHMARKS if not args.filters or any(f in n for f in args.filters)]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # 登録時に更新される検索索引・カード画像を、作業ディレクトリの .cache ではなく tmp に置く
+        os.environ["QUIZ_SEARCH_INDEX"] = os.path.join(tmp, "search.sqlite3")
+        os.environ["QUIZ_THUMB_DIR"] = os.path.join(tmp, "thumbs")
+        search.SearchIndex(os.environ["QUIZ_SEARCH_INDEX"]).rebuild([])  # 作成済みにして、裏での作り直しを起こさない
+        ctx = {"tmp": tmp, "quizzes": args.quizzes}
+        for name in names:
+            fn = BENCHMARKS[name](ctx)
+            results[name] = measure(fn, args.repeat, args.min_time)
+            print(f"{name:40s} {_fmt(results[name]['median'])}  (x{results[name]['number']})")
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "params": {"quizzes": args.quizzes, "repeat": args.repeat, "min_time": args.min_time},
+        "results": results,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{commit}.json")
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"-> {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n{baseline.get('commit')} -> {commit}")
+        slower = 0
+        for name, old, new, ratio in compare(results, baseline):
+            mark = "  <-- 遅くなった" if ratio >= REGRESSION_THRESHOLD else ""
+            slower += bool(mark)
+            print(f"{name:40s} {_fmt(old)} -> {_fmt(new)}  x{ratio:.2f}{mark}")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""診断の一括インポート / エクスポート (JSONL: 1行に1件)
+
+    python bulk.py export quizzes.jsonl [--public-only] [--html out_dir]
+    python bulk.py import quizzes.jsonl [--email owner@example.com] [--preserve] [--errors errors.jsonl]
+
+ファイル名に - を指定すると標準入出力を使う。どちらも少しずつ読み書きするので、
+件数が多くてもメモリの使用量は一定。
+
+インポートする行は、エクスポートした行 ({"content": {...}, "email": ..., "is_public": ...})
+または構成案 (エディタの draft_data と同じ形) そのもの。1行ずつ検証し、
+BATCH_SIZE 件ごとにまとめて登録する。不正な行は行番号とエラー内容を記録して飛ばす。
+"""
+import argparse
+import json
+import math
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import export_static
+import logic
+
+BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+EXPORT_COLUMNS = "id, email, title, content, is_public, price, views, likes, created_at"
+PRESERVED_COLUMNS = ("id", "views", "likes", "created_at")
+
+DRAFT_TEXT_FIELDS = ("page_title", "main_heading", "intro_text", "image_keyword", "color_main")
+RESULT_TEXT_FIELDS = ("title", "desc", "btn", "link", "line_url", "line_text", "line_img")
+_COLOR = re.compile(r"^#[0-9a-fA-F]{6}$")
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def validate_draft(draft):
+    """構成案 (draft_data) の形を確認し、問題の一覧を返す (問題がなければ空)"""
+    if not isinstance(draft, dict):
+        return ["content がオブジェクトではありません"]
+    errors = []
+    for key in DRAFT_TEXT_FIELDS:
+        if key in draft and not isinstance(draft[key], str):
+            errors.append(f"{key} が文字列ではありません")
+    if not (isinstance(draft.get("main_heading"), str) and draft["main_heading"].strip()):
+        errors.append("main_heading (タイトル) がありません")
+    if isinstance(draft.get("color_main"), str) and not _COLOR.match(draft["color_main"]):
+        errors.append("color_main は #RRGGBB 形式で指定してください")
+
+    results = draft.get("results")
+    if not isinstance(results, dict) or not results:
+        errors.append("results がありません")
+        results = {}
+    for t, r in results.items():
+        if not isinstance(r, dict):
+            errors.append(f"results.{t} がオブジェクトではありません")
+            continue
+        for key in RESULT_TEXT_FIELDS:
+            if key in r and not isinstance(r[key], str):
+                errors.append(f"results.{t}.{key} が文字列ではありません")
+        # 結果の表示で title / desc をそのまま使うので、どちらも文字列で必須
+        if not (isinstance(r.get("title"), str) and r["title"].strip()):
+            errors.append(f"results.{t}.title がありません")
+        if not isinstance(r.get("desc"), str):
+            errors.append(f"results.{t}.desc がありません")
+
+    questions = draft.get("questions")
+    if not isinstance(questions, list) or not questions:
+        errors.append("questions がありません")
+        questions = []
+    for qi, q in enumerate(questions, 1):
+        if not isinstance(q, dict) or not isinstance(q.get("question"), str):
+            errors.append(f"Q{qi}: question がありません")
+            continue
+        answers = q.get("answers")
+        if not isinstance(answers, list) or not answers:
+            errors.append(f"Q{qi}: answers がありません")
+            continue
+        for ai, a in enumerate(answers, 1):
+            if not isinstance(a, dict) or not isinstance(a.get("text"), str):
+                errors.append(f"Q{qi}-{ai}: text がありません")
+                continue
+            points = a.get("points")
+            if points is not None:
+                # json.loads は NaN / Infinity も通すので、有限の数だけを認める
+                if not isinstance(points, dict) or not points or not all(
+                        isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v)
+                        for v in points.values()):
+                    errors.append(f"Q{qi}-{ai}: points は {{結果タイプ: 点数}} で指定してください")
+                else:
+                    unknown = [t for t in points if t not in results]
+                    if unknown:
+                        errors.append(f"Q{qi}-{ai}: points の {', '.join(map(repr, unknown))} が results にありません")
+            elif not isinstance(a.get("type"), str) or a["type"] not in results:
+                errors.append(f"Q{qi}-{ai}: type {a.get('type')!r} が results にありません")
+    return errors
+
+
+def to_record(obj, email=None, preserve=False):
+    """JSONL の1行 (dict) を quizzes テーブルの行にする。不正なら InvalidRecord"""
+    if not isinstance(obj, dict):
+        raise InvalidRecord("行がオブジェクトではありません")
+    wrapped = "content" in obj
+    draft = obj["content"] if wrapped else obj
+    errors = validate_draft(draft)
+    if errors:
+        raise InvalidRecord("; ".join(errors))
+    owner = (obj.get("email") if wrapped else None) or email
+    if not owner:
+        raise InvalidRecord("email がありません (--email で既定値を指定できます)")
+    price = obj.get("price", 0) if wrapped else 0
+    if not isinstance(price, int) or isinstance(price, bool) or price < 0:
+        raise InvalidRecord("price は0以上の整数で指定してください")
+    record = logic.build_quiz_record(owner, draft, bool(obj.get("is_public")) if wrapped else False, price)
+    if preserve and wrapped:
+        record.update({k: obj[k] for k in PRESERVED_COLUMNS if obj.get(k) is not None})
+    return record
+
+
+def _report_error(report, line_no, error):
+    report["failed"] += 1
+    if len(report["errors"]) < MAX_REPORTED_ERRORS:
+        report["errors"].append({"line": line_no, "error": str(error)})
+
+
+def _flush(repo, batch, report):
+    """まとめて登録し、失敗したら1件ずつ登録し直して不正な行を特定する"""
+    if not batch:
+        return
+    try:
+        logic.insert_quizzes(repo, [record for _, record in batch])
+        report["imported"] += len(batch)
+        report["batches"] += 1
+        return
+    except Exception:
+        pass
+    for line_no, record in batch:
+        try:
+            logic.insert_quizzes(repo, [record])
+            report["imported"] += 1
+        except Exception as e:
+            _report_error(report, line_no, e)
+    report["batches"] += 1
+
+
+def import_jsonl(repo, lines, batch_size=BATCH_SIZE, email=None, preserve=False):
+    """JSONL を読み込んで登録する。途中の不正な行では止めずに最後まで進める
+
+    戻り値: {"imported": 件数, "failed": 件数, "batches": 往復回数, "errors": [{"line", "error"}, ...]}
+    errors は先頭の MAX_REPORTED_ERRORS 件まで。
+    """
+    report = {"imported": 0, "failed": 0, "batches": 0, "errors": []}
+    batch = []
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            batch.append((line_no, to_record(json.loads(line), email, preserve)))
+        except (ValueError, KeyError, TypeError) as e:
+            _report_error(report, line_no, e)
+            continue
+        if len(batch) >= batch_size:
+            _flush(repo, batch, report)
+            batch = []
+    _flush(repo, batch, report)
+    return report
+
+
+def iter_export(repo, public_only=False, page_size=BATCH_SIZE):
+    """エクスポートする行を1件ずつ返す (id 順に page_size 件ずつ読み出す)"""
+    return logic.iter_quizzes(repo, EXPORT_COLUMNS, public_only, page_size)
+
+
+def export_jsonl(repo, out, public_only=False, html_dir=None, workers=None, standalone=True):
+    """JSONL を書き出し、書き出した件数を返す。html_dir を指定すると診断ページも並列に書き出す"""
+    count = 0
+    pool, pending = None, []
+    if html_dir:
+        os.makedirs(html_dir, exist_ok=True)
+        pool = ProcessPoolExecutor(max_workers=workers)
+        window = (workers or os.cpu_count() or 1) * 4  # 同時に抱える描画の数 (メモリを一定に保つ)
+    try:
+        for row in iter_export(repo, public_only):
+            out.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+            count += 1
+            if pool is not None:
+                path = os.path.join(html_dir, f"{row['id']}.html")
+                pending.append(pool.submit(export_static._render_quiz, (path, row.get("content") or {}, standalone)))
+                if len(pending) >= window:
+                    pending.pop(0).result()
+        for future in pending:
+            future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return count
+
+
+def _open(path, mode):
+    if path == "-":
+        return sys.stdin if "r" in mode else sys.stdout
+    return open(path, mode, encoding="utf-8")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="診断を JSONL で一括インポート / エクスポートする")
+    parser.add_argument("--supabase-url", default=None)
+    parser.add_argument("--supabase-key", default=None)
+    parser.add_argument("--sqlite", default=None, help="Supabase の代わりにローカルの SQLite を使う")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="quizzes を JSONL に書き出す")
+    p_export.add_argument("path", help="出力ファイル (- で標準出力)")
+    p_export.add_argument("--public-only", action="store_true")
+    p_export.add_argument("--html", default=None, help="診断ページ (id.html) も書き出すディレクトリ")
+    p_export.add_argument("--workers", type=int, default=None)
+    p_export.add_argument("--cdn", action="store_true", help="Tailwind CDN を読み込む従来形式でHTMLを書き出す")
+
+    p_import = sub.add_parser("import", help="JSONL を読み込んで quizzes に登録する")
+    p_import.add_argument("path", help="入力ファイル (- で標準入力)")
+    p_import.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    p_import.add_argument("--email", default=None, help="email のない行に使う作成者のメールアドレス")
+    p_import.add_argument("--preserve", action="store_true", help="id・閲覧数・いいね数・作成日時を引き継ぐ")
+    p_import.add_argument("--errors", default=None, help="不正な行の一覧を JSONL で書き出すファイル")
+    args = parser.parse_args(argv)
+
+    repo = logic.connect_storage(args.supabase_url, args.supabase_key, args.sqlite)
+    if repo is None:
+        print("保存先の接続情報がありません (SUPABASE_URL / SUPABASE_KEY または QUIZ_SQLITE_PATH)", file=sys.stderr)
+        return 1
+
+    if args.command == "export":
+        out = _open(args.path, "w")
+        try:
+            count = export_jsonl(repo, out, args.public_only, args.html, args.workers, standalone=not args.cdn)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print(f"エクスポート {count} 件", file=sys.stderr)
+        return 0
+
+    src = _open(args.path, "r")
+    try:
+        report = import_jsonl(repo, src, args.batch_size, args.email, args.preserve)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+    print(f"インポート {report['imported']} 件 / 失敗 {report['failed']} 件 ({report['batches']} 回に分けて登録)",
+          file=sys.stderr)
+    if args.errors:
+        with open(args.errors, "w", encoding="utf-8") as f:
+            for e in report["errors"]:
+                f.write(json.dumps(e, ensure_ascii=False) + "\n")
+    else:
+        for e in report["errors"][:20]:
+            print(f"  {e['line']}行目: {e['error']}", file=sys.stderr)
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
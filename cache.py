@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """プロセス内で共有するLRUキャッシュ
+
+    合計バイト数 (max_bytes) と件数 (max_items) で上限を管理し、
+    ttl (秒) を指定すると期限切れの値は取得時に捨てる。
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, sizeof=len, max_items=None, ttl=None):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.ttl = ttl
+        self._sizeof = sizeof
+        self._data = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[2] is not None and item[2] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        size = self._sizeof(value)
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            # 上限より大きいものはキャッシュしない
+            if size > self.max_bytes:
+                return
+            self._data[key] = (value, size, expires_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes or (self.max_items and len(self._data) > self.max_items):
+                _, (_, old_size, _) = self._data.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def _remove(self, key):
+        self._bytes -= self._data.pop(key)[1]
+
+    def get_or_set(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "items": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class SWRCache:
+    """stale-while-revalidate 方式のキャッシュ
+
+    fresh_ttl 秒以内の値はそのまま返す。max_age 秒以内の古い値は
+    そのまま返しつつ、裏のスレッドで1回だけ読み直す。
+    それより古い・存在しない場合は loader をその場で呼ぶ (同じキーは1回にまとめる)。
+    """
+
+    def __init__(self, fresh_ttl=30, max_age=600):
+        self.fresh_ttl = fresh_ttl
+        self.max_age = max_age
+        self._data = {}  # key -> (value, loaded_at)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._refreshing = set()
+        self._generation = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refresh_errors = 0
+
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[1]
+            if age < self.fresh_ttl:
+                self.hits += 1
+                return entry[0]
+            if age < self.max_age:
+                self.stale_hits += 1
+                self._refresh_in_background(key, loader)
+                return entry[0]
+        self.misses += 1
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # 待っている間に他のセッションが読み込んでいればそれを使う
+            with self._lock:
+                entry = self._data.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.fresh_ttl:
+                return entry[0]
+            return self._load(key, loader)
+
+    def _load(self, key, loader):
+        with self._lock:
+            generation = self._generation
+        value = loader()
+        with self._lock:
+            # 読み込み中に invalidate されていたら保存しない
+            if generation == self._generation:
+                self._data[key] = (value, time.monotonic())
+        return value
+
+    def _refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._load(key, loader)
+            except Exception:
+                self.refresh_errors += 1
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name="swr-refresh", daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.stale_hits + self.misses
+            return {
+                "items": len(self._data),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "refresh_errors": self.refresh_errors,
+                "hit_rate": (self.hits + self.stale_hits) / total if total else 0.0,
+            }
@@ -0,0 +1,145 @@
+import atexit
+import threading
+from collections import defaultdict
+
+
+class WriteBehindBuffer:
+    """メモリに溜めたものを、バックグラウンドスレッドがまとめて書き込むバッファの共通部分
+
+    interval 秒ごと、またはサブクラスが _notify_full() を呼んだ時点で flush() する。
+    書き込みに失敗した分は次回に戻すが、max_retries 回続けて失敗したら破棄して stats["dropped"] に数える。
+    サブクラスは次のメソッドを実装する (_take / _restore はロックを持った状態で呼ばれる):
+        _take()          溜まっている分を取り出して空にする (なければ None)
+        _write(batch)    まとめて書き込む (失敗したら例外)
+        _restore(batch)  書き込めなかった分を戻す (戻しきれない分は stats["dropped"] に数える)
+        _count(batch)    batch の件数 (stats に数える単位)
+    """
+
+    thread_name = "write-behind-buffer"
+
+    def __init__(self, interval, max_pending, max_retries=3):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._retries = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.stats = {
+            "flushes": 0,         # 成功したまとめ書き込みの回数
+            "flushed_rows": 0,    # まとめ書き込みで送った件数
+            "failed_flushes": 0,  # 失敗したまとめ書き込みの回数
+            "dropped": 0,         # 破棄した件数 (バッファ溢れ・再試行上限)
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def _notify_full(self):
+        self._wake.set()
+
+    def flush(self):
+        """溜まっている分を1回のまとめ書き込みで送る"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._take()
+            if batch is None:
+                return True
+            try:
+                self._write(batch)
+            except Exception:
+                self.stats["failed_flushes"] += 1
+                self._retries += 1
+                if self._retries > self.max_retries:
+                    # 書き込み先が復旧しない場合は諦めて破棄する
+                    self.stats["dropped"] += self._count(batch)
+                    self._retries = 0
+                    return False
+                with self._lock:
+                    self._restore(batch)
+                return False
+            self._retries = 0
+            self.stats["flushes"] += 1
+            self.stats["flushed_rows"] += len(batch)
+            return True
+
+    def _count(self, batch):
+        return len(batch)
+
+    def close(self):
+        """停止時に残りを書き込む"""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval + 5)
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+            self.flush()
+
+
+class CounterBuffer(WriteBehindBuffer):
+    """閲覧数・いいね数の書き込みをまとめて行うバッファ (write-behind)
+
+    add() はメモリ上で quiz_id ごとに加算するだけなので、画面表示を待たせない。
+    バックグラウンドスレッドが interval 秒ごと、または溜まった件数が
+    max_pending を超えた時点で flush_fn にまとめて渡す。
+    flush_fn には [{"id": quiz_id, "views": n, "likes": m}, ...] が渡される。
+    """
+
+    thread_name = "counter-buffer"
+
+    def __init__(self, flush_fn, interval=5.0, max_pending=500, max_ids=20000, max_retries=3):
+        super().__init__(interval, max_pending, max_retries)
+        self._flush_fn = flush_fn
+        self.max_ids = max_ids
+        self._pending = defaultdict(lambda: [0, 0])  # quiz_id -> [views, likes]
+        self.stats["added"] = 0  # add() された件数
+
+    def add(self, quiz_id, views=0, likes=0):
+        with self._lock:
+            if quiz_id not in self._pending and len(self._pending) >= self.max_ids:
+                self.stats["dropped"] += views + likes
+                return False
+            counts = self._pending[quiz_id]
+            counts[0] += views
+            counts[1] += likes
+            self.stats["added"] += views + likes
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._notify_full()
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _take(self):
+        if not self._pending:
+            return None
+        batch, self._pending = self._pending, defaultdict(lambda: [0, 0])
+        return batch
+
+    def _write(self, batch):
+        self._flush_fn([{"id": k, "views": v, "likes": l} for k, (v, l) in batch.items()])
+
+    def _count(self, batch):
+        return sum(v + l for v, l in batch.values())
+
+    def _restore(self, batch):
+        # 次回のまとめ書き込みに戻す
+        for k, (v, l) in batch.items():
+            counts = self._pending[k]
+            counts[0] += v
+            counts[1] += l
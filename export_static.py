@@ -0,0 +1,146 @@
+"""公開中の診断を静的HTMLとして書き出すバッチ
+
+    python export_static.py --out public_html
+
+出力ディレクトリには q/<id>.html (診断ページ) と index.html (ポータル一覧) を作成する。
+前回の content ハッシュを .manifest.json に保存しておき、変更のあった診断だけを
+プロセスプールで並列に再生成する。nginx や CDN からそのまま配信できる。
+"""
+import argparse
+import html
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import logic
+import styles
+
+MANIFEST_NAME = ".manifest.json"
+EXPORT_COLUMNS = "id, title, content, summary, image_keyword, views, likes, created_at"
+
+INDEX_CSS = """
+<style>
+body { font-family: 'Noto Sans JP', sans-serif; margin: 0; background: #ffffff; color: #333333; }
+.block-container { margin: 0 auto; padding: 1rem; }
+.quiz-grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(300px, 1fr)); gap: 1rem; }
+.card-img-box { height: 180px; overflow: hidden; position: relative; background-color: #f1f5f9; }
+.card-img { width: 100%; height: 100%; object-fit: cover; }
+</style>
+"""
+
+
+def _write_file(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _render_quiz(job):
+    """プロセスプール側で1件を描画して書き出す"""
+    path, content, standalone = job
+    _write_file(path, logic.generate_html_content(content, standalone=standalone))
+    return path
+
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def render_index(quizzes):
+    """ポータル一覧と同じカードを並べた index.html"""
+    cards = []
+    for q in quizzes:
+        card = styles.get_card_content_html(
+            html.escape(q.get('title') or '無題'),
+            html.escape(q.get('summary') or ''),
+            logic.card_image_url(q),
+            q.get('views') or 0,
+            q.get('likes') or 0,
+            logic.card_image_sources(q),
+        )
+        cards.append(f'<a class="quiz-card-link" href="q/{q["id"]}.html"><div class="quiz-card">{card}</div></a>')
+    return f"""<!DOCTYPE html>
+<html lang="ja">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>診断クイズメーカー</title>
+    {styles.PORTAL_CSS}
+    {INDEX_CSS}
+</head>
+<body>
+    <div class="block-container">
+        {styles.HERO_HTML}
+        <h3>📚 新着の診断</h3>
+        <div class="quiz-grid">{"".join(cards)}</div>
+    </div>
+</body>
+</html>"""
+
+
+def export(repo, out_dir, workers=None, force=False, standalone=True):
+    """公開中の診断を書き出し、(再生成した件数, 削除した件数) を返す"""
+    quiz_dir = os.path.join(out_dir, "q")
+    os.makedirs(quiz_dir, exist_ok=True)
+    old_manifest = {} if force else load_manifest(out_dir)
+    manifest, jobs, index_rows = {}, [], []
+
+    for q in logic.iter_quizzes(repo, EXPORT_COLUMNS, public_only=True):
+        content = q.get('content') or {}
+        # テンプレート・CSS を変えたときも書き直すように、描画処理のバージョンも含める
+        digest = f"{logic.content_hash(content)}:{'standalone' if standalone else 'cdn'}:{logic.RENDER_VERSION}"
+        manifest[q['id']] = digest
+        path = os.path.join(quiz_dir, f"{q['id']}.html")
+        if old_manifest.get(q['id']) != digest or not os.path.exists(path):
+            jobs.append((path, content, standalone))
+        q.pop('content', None)
+        index_rows.append(q)
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(_render_quiz, jobs, chunksize=16):
+                pass
+
+    # 非公開・削除された診断のページを消す
+    removed = 0
+    for quiz_id in old_manifest.keys() - manifest.keys():
+        try:
+            os.remove(os.path.join(quiz_dir, f"{quiz_id}.html"))
+            removed += 1
+        except OSError:
+            pass
+
+    index_rows.sort(key=lambda q: q.get('created_at') or '', reverse=True)
+    _write_file(os.path.join(out_dir, "index.html"), render_index(index_rows))
+    _write_file(os.path.join(out_dir, MANIFEST_NAME), json.dumps(manifest, ensure_ascii=False))
+    return len(jobs), removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="公開中の診断を静的HTMLとして書き出す")
+    parser.add_argument("--out", default="public_html", help="出力ディレクトリ")
+    parser.add_argument("--workers", type=int, default=None, help="並列プロセス数 (省略時はCPU数)")
+    parser.add_argument("--force", action="store_true", help="変更の有無に関わらず全件を再生成する")
+    parser.add_argument("--cdn", action="store_true", help="Tailwind CDN / Google Fonts を読み込む従来形式で書き出す")
+    parser.add_argument("--supabase-url", default=None)
+    parser.add_argument("--supabase-key", default=None)
+    parser.add_argument("--sqlite", default=None, help="Supabase の代わりにローカルの SQLite から読む")
+    args = parser.parse_args(argv)
+
+    repo = logic.connect_storage(args.supabase_url, args.supabase_key, args.sqlite)
+    if repo is None:
+        print("保存先の接続情報がありません (SUPABASE_URL / SUPABASE_KEY または QUIZ_SQLITE_PATH)", file=sys.stderr)
+        return 1
+    rendered, removed = export(repo, args.out, args.workers, args.force, standalone=not args.cdn)
+    print(f"再生成 {rendered} 件 / 削除 {removed} 件 -> {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""外部サービスのローカル代替 (ベンチマーク・負荷試験用)
+
+ネットワークなしでアプリの処理を動かすための偽物。どれも latency 秒の待ちを
+入れられるので、外部サービスが遅い場合の振る舞いも再現できる。
+
+    FakeOpenAI        chat.completions.create (stream=True にも対応)
+    FakeSMTPConnection mailer.SMTPConnection と同じ send / close
+    FakeStripe        checkout.Session.create / retrieve
+    FakeImageSource   thumbnails.fetch と同じ呼び出し方で、URL ごとに決まった画像を返す
+    SlowRepository    保存先 (storage.*Repository) の各呼び出しに遅延を足す
+"""
+import copy
+import hashlib
+import io
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+
+def _sleep(latency):
+    if latency:
+        time.sleep(latency() if callable(latency) else latency)
+
+
+def jittered(base, spread=0.5, rng=None):
+    """base 秒 ± spread 割のばらつきを持つ遅延 (latency 引数に渡す)"""
+    rng = rng or random.Random(0)
+    return lambda: base * (1 + rng.uniform(-spread, spread))
+
+
+# --- 診断データ ---
+def make_quiz(num_questions=5, num_options=4, types="ABC", text_len=40, desc_len=300, seed=0, special=False):
+    """テスト用の診断 content を作る
+
+    special=True のときは HTML・JS にとって扱いにくい文字 (<, &, 引用符, 改行, 絵文字) を混ぜる。
+    """
+    rng = random.Random(seed)
+    noise = "<b>&amp;\"'\n😀</script>" if special else ""
+
+    def text(n):
+        base = "".join(rng.choice("あいうえおかきくけこさしすせそ診断結果質問") for _ in range(n))
+        return base + noise
+
+    return {
+        "page_title": text(12),
+        "main_heading": text(16),
+        "intro_text": text(text_len * 2),
+        "color_main": "#2563eb",
+        "image_keyword": "abstract",
+        "results": {
+            t: {"title": text(10), "desc": text(desc_len), "btn": "詳しく見る", "link": "https://example.com/",
+                "line_url": "", "line_text": "", "line_img": ""}
+            for t in types
+        },
+        "questions": [
+            {"question": text(text_len),
+             "answers": [{"text": text(text_len // 2), "type": rng.choice(types)} for _ in range(num_options)]}
+            for _ in range(num_questions)
+        ],
+    }
+
+
+QUIZ_SIZES = {
+    "small": dict(num_questions=5, num_options=4),
+    "large": dict(num_questions=30, num_options=6, types="ABCDEF", desc_len=2000),
+    # 上限近くまで大きく、特殊文字だらけの診断
+    "pathological": dict(num_questions=100, num_options=20, types="ABCDEFGHIJ", text_len=200,
+                         desc_len=20000, special=True),
+}
+
+
+def seed_repository(repo, count, public_ratio=0.9, seed=0):
+    """保存先に count 件の診断を登録し、id のリストを返す"""
+    import logic
+    rng = random.Random(seed)
+    content = make_quiz(seed=seed)
+    ids = []
+    for i in range(count):
+        draft = copy.deepcopy(content)
+        draft["main_heading"] = f"診断 {i}"
+        row = repo.insert(logic.build_quiz_record("bench@example.com", draft, rng.random() < public_ratio, 0))
+        ids.append(row["id"])
+    repo.increment_counters([{"id": i, "views": rng.randrange(10000), "likes": rng.randrange(500)} for i in ids])
+    return ids
+
+
+# --- OpenAI ---
+def _chunk(content=None, usage=None):
+    choices = [] if content is None else [SimpleNamespace(delta=SimpleNamespace(content=content))]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class _Stream:
+    def __init__(self, chunks, chunk_latency):
+        self._chunks = iter(chunks)
+        self._chunk_latency = chunk_latency
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        _sleep(self._chunk_latency)
+        return next(self._chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeOpenAI:
+    """OpenAI クライアントの代わり。固定の構成案 (JSON) を返す
+
+    latency: 最初の応答までの秒数 / chunk_latency: チャンクごとの秒数
+    """
+
+    def __init__(self, draft=None, latency=0.0, chunk_size=16, chunk_latency=0.0):
+        self.draft = draft or make_quiz()
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_latency = chunk_latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model=None, messages=None, stream=False, **kwargs):
+        self.calls += 1
+        _sleep(self.latency)
+        text = json.dumps(self.draft, ensure_ascii=False)
+        usage = SimpleNamespace(prompt_tokens=400, completion_tokens=len(text) // 2)
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+        pieces = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        return _Stream(itertools.chain(map(_chunk, pieces), [_chunk(usage=usage)]), self.chunk_latency)
+
+
+# --- SMTP ---
+class FakeSMTPConnection:
+    """送ったメールを messages に溜めるだけの SMTP 接続"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = []
+        self.last_used = 0.0
+        self._lock = threading.Lock()
+
+    def send(self, msg):
+        _sleep(self.latency)
+        with self._lock:
+            self.messages.append(msg)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        pass
+
+
+# --- Stripe ---
+class FakeStripe:
+    """stripe モジュールの代わり。作成した決済はすべて支払い済みとして返す"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sessions = {}
+        self.checkout = SimpleNamespace(Session=SimpleNamespace(create=self._create, retrieve=self._retrieve))
+
+    def _create(self, metadata=None, success_url="", **kwargs):
+        _sleep(self.latency)
+        session_id = "cs_test_" + uuid.uuid4().hex
+        session = SimpleNamespace(
+            id=session_id, url=f"https://checkout.example.com/{session_id}",
+            payment_status="paid", metadata=dict(metadata or {}),
+        )
+        self.sessions[session_id] = session
+        return session
+
+    def _retrieve(self, session_id):
+        _sleep(self.latency)
+        return self.sessions[session_id]
+
+
+# --- 画像生成 (カード画像の元画像) ---
+class FakeImageSource:
+    """AI 画像生成の代わり。URL のハッシュで色を決めたグラデーションの PNG を返す"""
+
+    def __init__(self, latency=0.0, size=(700, 360), fail=False):
+        self.latency = latency
+        self.size = size
+        self.fail = fail
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def __call__(self, url, timeout=None):
+        from PIL import Image
+
+        _sleep(self.latency)
+        with self._lock:
+            self.requests.append(url)
+        if self.fail:
+            raise OSError(f"image source unavailable: {url}")
+        r, g, b = hashlib.sha256(url.encode("utf-8")).digest()[:3]
+        image = Image.linear_gradient("L").resize(self.size)
+        image = Image.merge("RGB", [image.point(lambda v, c=c: (v + c) % 256) for c in (r, g, b)])
+        out = io.BytesIO()
+        image.save(out, "PNG")
+        return out.getvalue()
+
+
+# --- 保存先 ---
+class SlowRepository:
+    """保存先の呼び出しごとに latency 秒待つ (ネットワーク越しの DB の代わり)"""
+
+    def __init__(self, repo, latency=0.0):
+        self._repo = repo
+        self.latency = latency
+        self.backend = f"{repo.backend}+latency"
+
+    def __getattr__(self, name):
+        attr = getattr(self._repo, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            _sleep(self.latency)
+            return attr(*args, **kwargs)
+        return call
@@ -0,0 +1,314 @@
+"""同時アクセスの負荷試験
+
+    python loadtest.py --users 20 --duration 60 --mix browser=5,player=10,liker=2,author=1
+    python loadtest.py --driver http --users 50 --mix player=9,answer=1      # play_server を直接呼ぶ
+    python loadtest.py --driver http --url http://127.0.0.1:8000 ...          # 起動中のサーバーへ送る
+
+外部サービス (保存先・OpenAI・SMTP・Stripe) はすべて fakes の代替に差し替え、
+--db-latency などで1回あたりの待ち時間を入れられる。保存先はローカルの SQLite に
+--quizzes 件を登録して使う (検索索引などのローカルのキャッシュも一時ディレクトリに置く)。
+シナリオごとに p50 / p95 / p99 と処理件数/秒を表示する。
+
+driver:
+    app   Streamlit の AppTest で app.py を実行する (1つの Streamlit プロセスに複数セッション)
+    http  play_server (ASGI) を同じプロセス内で呼ぶ。--url を指定するとそのサーバーへ HTTP で送る
+
+シナリオ:
+    browser     ポータル一覧のいずれかのページを開く (app)
+    player      診断ページを開く (app / http)
+    liker       診断ページを開いて「いいね」する (app)
+    author      構成案を入力済みの状態から URL発行 (登録 + メール) する (app)
+    ai_author   AIで構成案を作成する (app)
+    answer      診断に回答して結果まで進んだイベントを送る (http)
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import ai
+import fakes
+import logic
+import mailer
+import play_server
+import search
+import storage
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+APP_TIMEOUT = 60  # 秒: AppTest の1回の実行の上限
+
+
+# --- 外部サービスの差し替え ---
+def install_fakes(repo, db_latency=0.0, openai_latency=0.0, openai_chunk_latency=0.0,
+                  smtp_latency=0.0, stripe_latency=0.0, outbox_path=None):
+    """logic / play_server が使う外部サービスをローカルの代替に差し替え、(保存先, 送信キュー) を返す"""
+    slow_repo = fakes.SlowRepository(repo, db_latency) if db_latency else repo
+    outbox = mailer.Outbox(outbox_path or os.path.join(tempfile.mkdtemp(), "outbox.sqlite3"))
+    mail_queue = mailer.Mailer("loadtest@example.com", fakes.FakeSMTPConnection(smtp_latency), outbox, 0.5).start()
+    openai_client = fakes.FakeOpenAI(latency=openai_latency, chunk_latency=openai_chunk_latency)
+    stripe = fakes.FakeStripe(stripe_latency)
+
+    logic.init_storage = lambda: slow_repo
+    logic.connect_storage = lambda *args, **kwargs: slow_repo
+    logic.get_mailer = lambda: mail_queue
+    logic.get_stripe = lambda: stripe
+    logic.get_openai_client = lambda api_key: openai_client
+    play_server._repo = slow_repo
+    return slow_repo, mail_queue
+
+
+def use_temp_caches(repo, tmp):
+    """検索索引・AI構成案キャッシュ・カード画像の保存先を tmp に移す (作業ディレクトリの .cache を汚さない)"""
+    os.environ["QUIZ_SEARCH_INDEX"] = os.path.join(tmp, "search.sqlite3")
+    os.environ["QUIZ_THUMB_DIR"] = os.path.join(tmp, "thumbs")
+    # 本番と同じく索引ができている状態から始める (裏での作り直しと計測を重ねない)
+    search.SearchIndex(os.environ["QUIZ_SEARCH_INDEX"]).rebuild(
+        logic.iter_quizzes(repo, logic.SEARCH_COLUMNS, public_only=True))
+    draft_cache = ai.DraftCache(os.path.join(tmp, "ai_drafts.sqlite3"))
+    ai.get_draft_cache = lambda: draft_cache
+
+
+# --- driver: Streamlit AppTest ---
+class AppDriver:
+    scenarios = ("browser", "player", "liker", "author", "ai_author")
+
+    def __init__(self, quiz_ids, total_pages):
+        from streamlit.testing.v1 import AppTest
+        self._app_test = AppTest
+        self.quiz_ids = quiz_ids
+        self.total_pages = total_pages
+
+    def _session(self):
+        at = self._app_test.from_file(APP_PATH, default_timeout=APP_TIMEOUT)
+        at.secrets["OPENAI_API_KEY"] = "sk-loadtest"
+        return at
+
+    @staticmethod
+    def _check(at):
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        return at
+
+    @staticmethod
+    def _widget(widgets, label):
+        for w in widgets:
+            if w.label == label or w.label.startswith(label):
+                return w
+        raise LookupError(label)
+
+    def browser(self, rng):
+        at = self._session()
+        at.session_state["current_page"] = rng.randint(1, self.total_pages)
+        self._check(at.run())
+
+    def player(self, rng):
+        at = self._session()
+        at.query_params["id"] = rng.choice(self.quiz_ids)
+        self._check(at.run())
+
+    def liker(self, rng):
+        at = self._session()
+        at.query_params["id"] = rng.choice(self.quiz_ids)
+        self._check(at.run())
+        self._check(self._widget(at.button, "🤍 この診断に「いいね」する").click().run())
+
+    def author(self, rng):
+        at = self._session()
+        at.session_state["page_mode"] = "create"
+        at.session_state["draft_data"] = fakes.make_quiz(seed=rng.randrange(1 << 30))
+        self._check(at.run())
+        self._widget(at.text_input, "Email").input("author@example.com")
+        self._check(self._widget(at.button, "🌐 URL発行").click().run())
+
+    def ai_author(self, rng):
+        at = self._session()
+        at.session_state["page_mode"] = "create"
+        at.session_state["is_admin"] = True  # 回数制限を外す
+        self._check(at.run())
+        # 毎回違うテーマにして、構成案キャッシュに当たらないようにする
+        self._widget(at.text_area, "テーマ・詳細設定").input(f"負荷試験 {rng.random()}")
+        self._check(self._widget(at.button, "AIで構成案を作成").click().run())
+
+
+# --- driver: play_server (ASGI) ---
+class HTTPDriver:
+    scenarios = ("player", "answer")
+
+    def __init__(self, quiz_ids, url=None):
+        self.quiz_ids = quiz_ids
+        self.url = url.rstrip("/") if url else None
+
+    def _asgi(self, method, path, body=b""):
+        async def call():
+            sent = []
+            messages = [{"type": "http.request", "body": body}]
+
+            async def receive():
+                return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+            async def send(message):
+                sent.append(message)
+            scope = {"type": "http", "method": method, "path": path, "query_string": b"",
+                     "headers": [(b"accept-encoding", b"gzip")]}
+            await play_server.app(scope, receive, send)
+            return sent[0]["status"]
+        return asyncio.run(call())
+
+    def _http(self, method, path, body=None):
+        req = urllib.request.Request(self.url + path, data=body, method=method,
+                                     headers={"Accept-Encoding": "gzip"})
+        with urllib.request.urlopen(req, timeout=30) as res:
+            res.read()
+            return res.status
+
+    def request(self, method, path, body=b""):
+        status = self._http(method, path, body or None) if self.url else self._asgi(method, path, body)
+        if status >= 400:
+            raise RuntimeError(f"{method} {path}: {status}")
+        return status
+
+    def player(self, rng):
+        self.request("GET", f"/q/{rng.choice(self.quiz_ids)}")
+
+    def answer(self, rng):
+        events = [{"t": "start"}] + [{"t": "answer", "q": q, "c": rng.randrange(4)} for q in range(5)]
+        events.append({"t": "result", "r": rng.choice("ABC")})
+        payload = {"quiz_id": rng.choice(self.quiz_ids), "session": f"{rng.random():.12f}", "events": events}
+        self.request("POST", play_server.EVENTS_PATH, json.dumps(payload).encode("utf-8"))
+
+
+# --- 実行と集計 ---
+def parse_mix(text):
+    """"browser=5,player=10" -> {"browser": 5.0, "player": 10.0}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(samples, errors, elapsed):
+    """シナリオごとの件数・エラー数・処理件数/秒・レイテンシ (秒)"""
+    report = {}
+    for name in sorted(set(samples) | set(errors)):
+        values = sorted(samples.get(name, []))
+        report[name] = {
+            "count": len(values),
+            "errors": errors.get(name, 0),
+            "throughput": len(values) / elapsed if elapsed else 0.0,
+            "mean": statistics.fmean(values) if values else 0.0,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else 0.0,
+        }
+    return report
+
+
+def run(driver, mix, users, duration, seed=0, think_time=0.0):
+    """users 人が duration 秒の間、mix の比率でシナリオを繰り返す"""
+    names, weights = list(mix), list(mix.values())
+    samples, errors, first_error = {}, {}, {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def user(index):
+        rng = random.Random(seed * 100003 + index)
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                getattr(driver, name)(rng)
+            except Exception as e:
+                with lock:
+                    errors[name] = errors.get(name, 0) + 1
+                    first_error.setdefault(name, repr(e))
+            else:
+                took = time.perf_counter() - started
+                with lock:
+                    samples.setdefault(name, []).append(took)
+            if think_time:
+                time.sleep(rng.expovariate(1 / think_time))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(user, range(users)))
+    return summarize(samples, errors, time.monotonic() - started), first_error
+
+
+def print_report(report, first_error):
+    print(f"{'scenario':12s} {'count':>7s} {'err':>5s} {'req/s':>8s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'max ms':>9s}")
+    for name, r in report.items():
+        print(f"{name:12s} {r['count']:7d} {r['errors']:5d} {r['throughput']:8.1f} "
+              f"{r['p50'] * 1000:9.1f} {r['p95'] * 1000:9.1f} {r['p99'] * 1000:9.1f} {r['max'] * 1000:9.1f}")
+    for name, error in first_error.items():
+        print(f"  {name}: {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="診断クイズメーカーの負荷試験")
+    parser.add_argument("--driver", choices=("app", "http"), default="app")
+    parser.add_argument("--url", default=None, help="http driver: 起動中の play_server の URL")
+    parser.add_argument("--mix", default=None, help="シナリオと比率 (例: browser=5,player=10,liker=2,author=1)")
+    parser.add_argument("--users", type=int, default=10, help="同時ユーザー数")
+    parser.add_argument("--duration", type=float, default=30.0, help="秒")
+    parser.add_argument("--think-time", type=float, default=0.0, help="操作の間の平均待ち時間 (秒)")
+    parser.add_argument("--quizzes", type=int, default=1000, help="事前に登録する診断の件数")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="保存先の呼び出し1回あたりの待ち (秒)")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="OpenAI の最初の応答までの待ち (秒)")
+    parser.add_argument("--openai-chunk-latency", type=float, default=0.005, help="OpenAI のチャンクごとの待ち (秒)")
+    parser.add_argument("--smtp-latency", type=float, default=0.3, help="SMTP 送信1通あたりの待ち (秒)")
+    parser.add_argument("--stripe-latency", type=float, default=0.3, help="Stripe API 1回あたりの待ち (秒)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="結果を JSON で保存するファイル")
+    args = parser.parse_args(argv)
+
+    driver_class = AppDriver if args.driver == "app" else HTTPDriver
+    mix = parse_mix(args.mix or ("browser=5,player=10,liker=2,author=1" if args.driver == "app" else "player=9,answer=1"))
+    unknown = set(mix) - set(driver_class.scenarios)
+    if unknown:
+        parser.error(f"{args.driver} driver では使えないシナリオ: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = storage.SQLiteRepository(os.path.join(tmp, "loadtest.sqlite3"))
+        quiz_ids = [i for i in fakes.seed_repository(repo, args.quizzes, seed=args.seed)
+                    if repo.get(i, "is_public")["is_public"]]
+        _, mail_queue = install_fakes(
+            repo, args.db_latency, args.openai_latency, args.openai_chunk_latency,
+            args.smtp_latency, args.stripe_latency, os.path.join(tmp, "outbox.sqlite3"),
+        )
+        use_temp_caches(repo, tmp)
+        if args.driver == "app":
+            driver = AppDriver(quiz_ids, max(1, len(quiz_ids) // 15))
+        else:
+            driver = HTTPDriver(quiz_ids, args.url)
+
+        print(f"driver={args.driver} users={args.users} duration={args.duration}s mix={mix}")
+        report, first_error = run(driver, mix, args.users, args.duration, args.seed, args.think_time)
+        print_report(report, first_error)
+        mail_queue.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "report": report, "errors": first_error}, f, ensure_ascii=False, indent=2)
+    return 1 if any(r["errors"] for r in report.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,79 @@
 import streamlit as st
 import json
-import smtplib
-from email.mime.text import MIMEText
-from supabase import create_client
+import re
+import hashlib
+import time
+import os
+import sys
+import importlib
+import subprocess
+import threading
+import urllib.parse
+
+import analytics
+import cache
+import counters
+import metrics
+import search
+import storage
+import thumbnails
+import trending
+
+# 重いSDK (openai / stripe / supabase / smtplib) や numpy を使う scoring は初回利用時に読み込む
+# 読み込みにかかった秒数は IMPORT_TIMINGS に記録し、管理者パネルで確認できる
+IMPORT_TIMINGS = {}
+
+def _lazy_import(name):
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        IMPORT_TIMINGS[name] = time.perf_counter() - start
+    return module
+
+def get_openai():
+    return _lazy_import("openai")
+
+@st.cache_resource
+def get_openai_client(api_key):
+    """全セッション共通の OpenAI クライアント (HTTP接続を使い回す)
+
+    再試行は ai.call_with_retries でまとめて行うため、SDK 側の再試行は無効にする。
+    """
+    return get_openai().OpenAI(api_key=api_key, max_retries=0, timeout=60)
+
+def get_stripe():
+    stripe = _lazy_import("stripe")
+    if not stripe.api_key and "stripe" in st.secrets:
+        stripe.api_key = st.secrets["stripe"]["api_key"]
+    return stripe
+
+def get_supabase_module():
+    return _lazy_import("supabase")
+
+def get_scoring():
+    """結果バランスの計算 (numpy)。エディタでしか使わないので、プレイ画面・ポータルでは読み込まない"""
+    return _lazy_import("scoring")
+
+def import_time_report(modules=("streamlit", "supabase", "openai", "stripe", "scoring"), top=20):
+    """別プロセスで python -X importtime を実行し、時間のかかったモジュールを返す
+
+    戻り値: [(モジュール名, 自身の時間ms, 累積ms), ...] (累積の大きい順)
+    """
+    code = "; ".join(f"import {m}" for m in modules)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          capture_output=True, text=True, timeout=120)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            self_us, cumulative_us, name = [p.strip() for p in line[len("import time:"):].split("|")]
+            rows.append((name, int(self_us) / 1000, int(cumulative_us) / 1000))
+        except ValueError:
+            continue  # 見出し行
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows[:top]
 
 # HTMLテンプレート
 # JS部分に同点時のランダム処理とconsole.logを追加
@@ -64,9 +135,29 @@ HTML_TEMPLATE_RAW = """<!DOCTYPE html>
     </div>
     <script>
     document.addEventListener('DOMContentLoaded', () => {
-        let questions = [], results = [], currentQuestionIndex = 0, userAnswers = [];
+        let questions = [], results = [], currentQuestionIndex = 0, userAnswers = [], userChoices = [];
         const quizArea = document.getElementById('quiz-area'), resultArea = document.getElementById('result-area');
         
+        // 回答データの送信 (送信先が設定されている場合のみ)。数件ずつ・ページを離れるときにまとめて送る
+        const analytics = [[ANALYTICS_CONFIG]];
+        const sessionKey = Math.random().toString(36).slice(2);
+        let pendingEvents = [];
+        function track(ev) {
+            if(!analytics) return;
+            pendingEvents.push(ev);
+            if(pendingEvents.length >= 10) flushEvents();
+        }
+        function flushEvents() {
+            if(!analytics || !pendingEvents.length) return;
+            const body = JSON.stringify({ quiz_id: analytics.quiz, session: sessionKey, events: pendingEvents });
+            pendingEvents = [];
+            if(!(navigator.sendBeacon && navigator.sendBeacon(analytics.url, body))) {
+                fetch(analytics.url, { method: 'POST', body, keepalive: true }).catch(() => {});
+            }
+        }
+        document.addEventListener('visibilitychange', () => { if(document.visibilityState === 'hidden') flushEvents(); });
+        window.addEventListener('pagehide', flushEvents);
+
         function shuffle(array) {
             for (let i = array.length - 1; i > 0; i--) {
                 const j = Math.floor(Math.random() * (i + 1));
@@ -79,11 +170,25 @@ HTML_TEMPLATE_RAW = """<!DOCTYPE html>
             const d = document.getElementById('quiz-data');
             questions = Array.from(d.querySelectorAll('[data-container="questions"] [data-item="question"]')).map(q => ({
                 text: q.querySelector('[data-key="text"]').textContent,
-                options: shuffle(Array.from(q.querySelectorAll('[data-key="option"]')).map(o => ({ text: o.textContent, points: JSON.parse(o.dataset.points||'{}') })))
+                options: shuffle(Array.from(q.querySelectorAll('[data-key="option"]')).map((o, idx) => ({ text: o.textContent, points: JSON.parse(o.dataset.points||'{}'), idx })))
             }));
             results = Array.from(d.querySelectorAll('[data-container="results"] [data-item="result"]')).map(r => ({ id: r.dataset.id, html: r.innerHTML }));
         }
 
+        // 同点時に使う疑似乱数。回答 (元の選択肢番号) から決まるので、
+        // サーバー側の scoring.py でも同じ結果を再現できる
+        function answerSeed(choices) {
+            let h = 2166136261;
+            for (const c of choices) { h ^= c; h = Math.imul(h, 16777619) >>> 0; }
+            return h;
+        }
+        function mulberry32(a) {
+            let t = (a + 0x6D2B79F5) | 0;
+            t = Math.imul(t ^ (t >>> 15), t | 1);
+            t ^= t + Math.imul(t ^ (t >>> 7), t | 61);
+            return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+        }
+
         // 修正: 同点時の処理を改善
         function calcResult() {
             const s = {};
@@ -102,13 +207,15 @@ HTML_TEMPLATE_RAW = """<!DOCTYPE html>
             // 最大値を持つ結果をすべて候補としてリストアップ
             const candidates = results.filter(r => (s[r.id] || 0) === max);
             
-            // 候補の中からランダムに1つ選ぶ (同点時の偏りを防ぐ)
-            const winner = candidates[Math.floor(Math.random() * candidates.length)];
+            // 候補の中から1つ選ぶ (同点時の偏りを防ぐ)
+            const winner = candidates[Math.floor(mulberry32(answerSeed(userChoices)) * candidates.length)];
             return winner;
         }
 
         function showResult() {
             const r = calcResult();
+            if(r) track({ t: 'result', r: r.id });
+            flushEvents();
             quizArea.classList.add('hidden');
             if(!r) return;
             resultArea.innerHTML = `<div class="result-card">${r.html}</div><div class="mt-6 text-center"><button class="restart-button" onclick="location.reload()">もう一度診断する</button></div>`;
@@ -128,36 +235,102 @@ HTML_TEMPLATE_RAW = """<!DOCTYPE html>
                 quizArea.querySelectorAll('.option-button').forEach(btn=>btn.classList.remove('selected'));
                 e.target.classList.add('selected');
                 userAnswers[currentQuestionIndex] = q.options[e.target.dataset.i].points;
+                userChoices[currentQuestionIndex] = q.options[e.target.dataset.i].idx;
                 nBtn.disabled=false;
             }));
-            nBtn.addEventListener('click', () => { if(userAnswers[currentQuestionIndex]==null)return; (currentQuestionIndex<questions.length-1)?(currentQuestionIndex++,dispQ()):showResult(); });
+            nBtn.addEventListener('click', () => { if(userAnswers[currentQuestionIndex]==null)return; track({ t: 'answer', q: currentQuestionIndex, c: userChoices[currentQuestionIndex] }); (currentQuestionIndex<questions.length-1)?(currentQuestionIndex++,dispQ()):showResult(); });
         }
-        function startQuiz() { currentQuestionIndex=0; userAnswers=[]; resultArea.classList.add('hidden'); quizArea.classList.remove('hidden'); dispQ(); }
+        function startQuiz() { currentQuestionIndex=0; userAnswers=[]; userChoices=[]; resultArea.classList.add('hidden'); quizArea.classList.remove('hidden'); track({ t: 'start' }); dispQ(); }
         loadData(); startQuiz();
     });
     </script>
 </body>
 </html>"""
 
-def generate_html_content(data):
-    html = HTML_TEMPLATE_RAW
-    html = html.replace("[[PAGE_TITLE]]", data.get('page_title', '診断'))
-    html = html.replace("[[MAIN_HEADING]]", data.get('main_heading', 'タイトル'))
-    html = html.replace("[[INTRO_TEXT]]", data.get('intro_text', ''))
-    # ★カラー設定を反映
-    html = html.replace("[[COLOR_MAIN]]", data.get('color_main', '#2563eb'))
-    
-    q_html = ""
-    for q in data.get('questions', []):
-        o_html = ""
+# テンプレートは起動時に一度だけ「固定部分」と「差し込み枠」に分解しておく
+_SLOT_PATTERN = re.compile(r"\[\[([A-Z_]+)\]\]")
+
+def _compile_template(raw):
+    """テンプレートを [固定文字列, 枠名, 固定文字列, 枠名, ...] の形に分解"""
+    parts = _SLOT_PATTERN.split(raw)
+    return parts[0::2], parts[1::2]
+
+_TEMPLATE_STATIC, _TEMPLATE_SLOTS = _compile_template(HTML_TEMPLATE_RAW)
+
+# --- 単体で動くHTML (standalone) 用 ---
+# Tailwind CDN (ブラウザ内JITコンパイラ) と Google Fonts を使わず、
+# テンプレートで使っているユーティリティクラスだけを事前にCSSとして埋め込む
+_PREFLIGHT_CSS = (
+    "*,::before,::after{box-sizing:border-box;border:0 solid #e5e7eb}"
+    "html{line-height:1.5;-webkit-text-size-adjust:100%}"
+    "body{margin:0;line-height:inherit}"
+    "h1,h2,p{margin:0}h1,h2{font-size:inherit;font-weight:inherit}"
+    "a{color:inherit;text-decoration:inherit}"
+    "button{font-family:inherit;font-size:100%;line-height:inherit;color:inherit;margin:0;padding:0;"
+    "background-color:transparent;background-image:none;text-transform:none;-webkit-appearance:button}"
+    "img{display:block;max-width:100%;height:auto}"
+)
+_UTILITY_CSS = {
+    "text-2xl": "font-size:1.5rem;line-height:2rem",
+    "text-lg": "font-size:1.125rem;line-height:1.75rem",
+    "font-bold": "font-weight:700",
+    "text-center": "text-align:center",
+    "mb-4": "margin-bottom:1rem",
+    "mb-8": "margin-bottom:2rem",
+    "mt-6": "margin-top:1.5rem",
+    "text-slate-700": "color:#334155",
+    "text-slate-800": "color:#1e293b",
+    "text-gray-600": "color:#4b5563",
+}
+_SYSTEM_FONTS = "'Noto Sans JP', 'Hiragino Kaku Gothic ProN', 'Hiragino Sans', Meiryo, system-ui, sans-serif"
+_CLASS_PATTERN = re.compile(r'class="([^"$]+)"')
+
+def _used_classes(*texts):
+    return {c for t in texts for m in _CLASS_PATTERN.findall(t) for c in m.split()}
+
+def _minify(segment):
+    """固定部分の字下げ・空行・行コメントを取り除く (差し込む内容には触れない)"""
+    segment = re.sub(r"\n[ \t]+", "\n", segment)
+    segment = re.sub(r"\n//[^\n]*", "", segment)
+    return re.sub(r"\n{2,}", "\n", segment)
+
+def _standalone_template(raw):
+    raw = raw.replace('    <script src="https://cdn.tailwindcss.com"></script>\n', '')
+    raw = re.sub(r'    <link href="https://fonts.googleapis.com/[^"]*" rel="stylesheet">\n', '', raw)
+    raw = raw.replace("font-family: 'Noto Sans JP', sans-serif;", f"font-family: {_SYSTEM_FONTS};")
+    raw = raw.replace("<style>", "<style>[[UTILITY_CSS]]", 1)
+    static, slots = _compile_template(raw)
+    return [_minify(s) for s in static], slots
+
+_STANDALONE_STATIC, _STANDALONE_SLOTS = _standalone_template(HTML_TEMPLATE_RAW)
+_STANDALONE_CLASSES = _used_classes(*_STANDALONE_STATIC)
+
+# 生成済みHTMLのキャッシュ (content のハッシュ -> HTML)
+RENDER_CACHE = cache.LRUCache(max_bytes=32 * 1024 * 1024, sizeof=lambda s: len(s.encode("utf-8")))
+
+def content_hash(data):
+    """quiz content の安定したハッシュ値 (キー順に依存しない)"""
+    payload = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def answer_points(ans):
+    """選択肢の加点 {結果タイプ: 点数}。points があればそれを使い、なければ type に1点"""
+    points = ans.get('points')
+    return points if points is not None else {ans['type']: 1}
+
+def _render_questions(questions):
+    q_parts = []
+    for q in questions:
+        o_parts = []
         for ans in q['answers']:
-            pts = json.dumps({ans['type']: 1}, ensure_ascii=False).replace('"', '&quot;')
-            o_html += f'<div data-key="option" data-points="{pts}">{ans["text"]}</div>'
-        q_html += f'<div data-item="question"><p data-key="text">{q["question"]}</p><div data-key="options">{o_html}</div></div>'
-    html = html.replace("[[QUESTIONS_HTML]]", q_html)
-    
-    r_html = ""
-    for k, v in data.get('results', {}).items():
+            pts = json.dumps(answer_points(ans), ensure_ascii=False).replace('"', '&quot;')
+            o_parts.append(f'<div data-key="option" data-points="{pts}">{ans["text"]}</div>')
+        q_parts.append(f'<div data-item="question"><p data-key="text">{q["question"]}</p><div data-key="options">{"".join(o_parts)}</div></div>')
+    return "".join(q_parts)
+
+def _render_results(results):
+    r_parts = []
+    for k, v in results.items():
         b_html = ""
         if v.get('link') and v.get('btn'):
             b_html = f'<div class="mt-6 text-center"><a href="{v["link"]}" target="_blank" class="flyer-link-button">{v["btn"]} ➤</a></div>'
@@ -168,43 +341,500 @@ def generate_html_content(data):
             img_tag = f'<img src="{v["line_img"]}" class="line-img">' if v.get('line_img') else ''
             line_html = f"""<div class="line-section"><p class="line-title">🎁 無料プレゼント！</p><p class="line-desc">{v.get('line_text', '公式LINE登録で詳細解説をプレゼント中！')}</p>{img_tag}<a href="{v['line_url']}" target="_blank" class="line-btn">LINEで受け取る</a></div>"""
         
-        r_html += f'<div data-item="result" data-id="{k}"><h2 data-key="title">{v["title"]}</h2><p data-key="description" class="result-text">{v["desc"]}</p>{b_html}{line_html}</div>'
-    
-    html = html.replace("[[RESULTS_HTML]]", r_html)
-    return html
+        r_parts.append(f'<div data-item="result" data-id="{k}"><h2 data-key="title">{v["title"]}</h2><p data-key="description" class="result-text">{v["desc"]}</p>{b_html}{line_html}</div>')
+    return "".join(r_parts)
+
+def _analytics_config(events_url, quiz_id):
+    if not (events_url and quiz_id):
+        return "null"
+    # </script> で途切れないようにエスケープ
+    return json.dumps({"url": events_url, "quiz": quiz_id}).replace("</", "<\\/")
+
+def _render(data, standalone=False, events_url=None, quiz_id=None):
+    values = {
+        "PAGE_TITLE": data.get('page_title', '診断'),
+        "MAIN_HEADING": data.get('main_heading', 'タイトル'),
+        "INTRO_TEXT": data.get('intro_text', ''),
+        # ★カラー設定を反映
+        "COLOR_MAIN": data.get('color_main', '#2563eb'),
+        "QUESTIONS_HTML": _render_questions(data.get('questions', [])),
+        "RESULTS_HTML": _render_results(data.get('results', {})),
+        "ANALYTICS_CONFIG": _analytics_config(events_url, quiz_id),
+    }
+    static, slots = _TEMPLATE_STATIC, _TEMPLATE_SLOTS
+    if standalone:
+        static, slots = _STANDALONE_STATIC, _STANDALONE_SLOTS
+        used = _STANDALONE_CLASSES | _used_classes(values["QUESTIONS_HTML"], values["RESULTS_HTML"])
+        values["UTILITY_CSS"] = _PREFLIGHT_CSS + "".join(
+            f".{name}{{{rule}}}" for name, rule in _UTILITY_CSS.items() if name in used
+        )
+    out = [static[0]]
+    for slot, segment in zip(slots, static[1:]):
+        out.append(values[slot])
+        out.append(segment)
+    return "".join(out)
+
+def generate_html_content(data, standalone=False, events_url=None, quiz_id=None, digest=None):
+    """診断HTMLを生成 (同じ content ならキャッシュから返す)
+
+    standalone=True のときは外部CDN・Webフォントを使わず、必要なCSSだけを埋め込んだ
+    圧縮済みのHTMLを返す (オフラインでも動作する)。
+    events_url と quiz_id を渡すと、回答・結果のイベントをその URL へ送信する。
+    digest に計算済みの content_hash(data) (get_quiz の行の content_hash) を渡すと、
+    キャッシュに当たったときは辞書を引くだけで済む。
+    """
+    with metrics.timed("render"):
+        key = render_key(data, standalone, events_url, quiz_id, digest)
+        return RENDER_CACHE.get_or_set(key, lambda: _render(data, standalone, events_url, quiz_id))
+
+def render_key(data, standalone=False, events_url=None, quiz_id=None, digest=None):
+    """RENDER_CACHE のキー (同じキーなら同じHTML)。play_server の gzip キャッシュ・ETag にも使う"""
+    return (digest or content_hash(data), standalone, events_url, quiz_id)
+
+# 描画処理全体のバージョン。テンプレート・埋め込むCSS・描画関数を変えて出力が変わるときは必ず上げる
+# (ETag と静的エクスポートの差分判定に含めて、古いHTMLが使われ続けないようにする)
+RENDER_VERSION = "2"
+
+def render_etag(key):
+    """render_key() の HTML の ETag"""
+    payload = "\0".join(str(k) for k in key) + "\0" + RENDER_VERSION
+    return '"' + hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32] + '"'
+
+def analytics_events_url():
+    """回答データの送信先 (環境変数 ANALYTICS_EVENTS_URL または secrets の [analytics])"""
+    url = os.environ.get("ANALYTICS_EVENTS_URL")
+    if url is None:
+        try:
+            url = st.secrets["analytics"]["events_url"]
+        except Exception:
+            url = None
+    return url or None
+
+@st.cache_resource
+def get_mailer():
+    """メール送信キュー (送信箱 + 送信スレッド)。secrets の [email] で接続先を変更できる
+
+    host / port / use_ssl / starttls を指定すると、aiosmtpd などのローカルSMTPでも試せる。
+    """
+    mailer = _lazy_import("mailer")
+    conf = st.secrets["email"]
+    connection = mailer.SMTPConnection(
+        conf.get("host", "smtp.gmail.com"), int(conf.get("port", 465)),
+        conf.get("address"), conf.get("password"),
+        use_ssl=conf.get("use_ssl", True), starttls=conf.get("starttls", False),
+    )
+    return mailer.Mailer(conf["address"], connection, mailer.Outbox(conf.get("outbox_path", mailer.OUTBOX_PATH))).start()
 
 def send_email(to_email, quiz_url, quiz_title):
+    """URL発行のお知らせメールを送信キューに入れる (実際の送信はバックグラウンド)"""
     try:
-        sender_email = st.secrets["email"]["address"]
-        sender_password = st.secrets["email"]["password"]
-        msg = MIMEText(f"診断URL: {quiz_url}\nタイトル: {quiz_title}")
-        msg['Subject'] = "【診断クイズメーカー】URL発行のお知らせ"
-        msg['From'] = sender_email
-        msg['To'] = to_email
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
+        with metrics.timed("email.enqueue"):
+            get_mailer().enqueue(
+                to_email,
+                "【診断クイズメーカー】URL発行のお知らせ",
+                f"診断URL: {quiz_url}\nタイトル: {quiz_title}",
+            )
         return True
-    except: return False
+    except Exception: return False
+
+def apply_ai_draft(data, state=None):
+    """AIの構成案 (途中までの内容でも可) をフォームの入力欄へ反映し、埋まった項目数を返す
+
+    state を省略すると st.session_state に書き込む。
+    """
+    if state is None:
+        state = st.session_state
+    filled = 0
+    for key in ['page_title', 'main_heading', 'intro_text']:
+        if key in data:
+            state[key] = data.get(key) or ''
+    if data.get('page_title') or data.get('main_heading'):
+        filled += 1
+    if 'image_keyword' in data:
+        state['image_keyword'] = data.get('image_keyword') or 'random'
+    
+    results = data.get('results')
+    if isinstance(results, dict):
+        for t in ['A','B','C']:
+            if isinstance(results.get(t), dict):
+                r = results[t]
+                state[f'res_title_{t}'] = r.get('title','')
+                state[f'res_desc_{t}'] = r.get('desc','')
+                state[f'res_btn_{t}'] = r.get('btn','')
+                state[f'res_link_{t}'] = r.get('link','')
+                filled += 1
+    
+    questions = data.get('questions')
+    if isinstance(questions, list):
+        for i,q in enumerate(questions):
+            if i>=5: break
+            if not isinstance(q, dict): continue
+            state[f'q_text_{i+1}'] = q.get('question','')
+            for j,a in enumerate(q.get('answers') or []):
+                if j>=4: break
+                if not isinstance(a, dict): continue
+                state[f'q{i+1}_a{j+1}_text'] = a.get('text','')
+                state[f'q{i+1}_a{j+1}_type'] = a.get('type') if a.get('type') in ('A','B','C') else 'A'
+            filled += 1
+    return filled
+
+# ポータル一覧のカード表示に必要な列だけを取得する (content 本体は読まない)
+PORTAL_CARD_COLUMNS = "id, title, summary, image_keyword, views, likes, trend_score, created_at"
+SUMMARY_LENGTH = 120
+
+def make_summary(content, limit=SUMMARY_LENGTH):
+    """カード用の短い紹介文 (登録時に summary 列へ保存する)"""
+    text = " ".join((content.get('intro_text') or '').split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+# カード画像は公開時に1回だけ取得・縮小して play_server の /thumbs/ から配信する (thumbnails.py)
+# 配信先 (環境変数 QUIZ_THUMB_BASE_URL または secrets の [thumbnails] base_url) が未設定なら、
+# 従来どおり画像生成の URL をそのまま使う
+def _thumbnail_setting(env, key):
+    value = os.environ.get(env)
+    if value is None:
+        try:
+            value = st.secrets["thumbnails"][key]
+        except Exception:
+            value = None
+    return value or None
+
+def thumbnail_base_url():
+    return _thumbnail_setting("QUIZ_THUMB_BASE_URL", "base_url")
+
+def thumbnail_dir():
+    return _thumbnail_setting("QUIZ_THUMB_DIR", "dir") or thumbnails.THUMB_DIR
+
+def thumbnail_source():
+    """元画像の URL テンプレート ({keyword} {seed} {width} {height})"""
+    return _thumbnail_setting("QUIZ_THUMB_SOURCE", "source") or thumbnails.SOURCE_TEMPLATE
+
+def _thumbnail_urls(quiz, base, fmt):
+    key = thumbnails.thumb_key(thumbnails.source_url(quiz, thumbnail_source()))
+    return [f"{base.rstrip('/')}/{thumbnails.filename(key, size, fmt)}" for size in thumbnails.SIZES]
+
+def card_image_url(quiz):
+    """ポータルのカード画像URL (JPEG の 1x)"""
+    base = thumbnail_base_url()
+    if base:
+        return _thumbnail_urls(quiz, base, "jpg")[0]
+    # 日本語キーワード対応
+    encoded_keyword = urllib.parse.quote(quiz.get('image_keyword') or 'abstract')
+    seed = quiz['id'][-4:]
+    return f"https://image.pollinations.ai/prompt/{encoded_keyword}%20{seed}?width=350&height=180&nologo=true"
+
+def card_image_sources(quiz):
+    """<picture> の <source> 用 [(type, srcset)] (対応ブラウザには WebP の 1x / 2x を使わせる)"""
+    base = thumbnail_base_url()
+    if not base:
+        return []
+    urls = _thumbnail_urls(quiz, base, "webp")
+    return [("image/webp", ", ".join(f"{url} {i}x" for i, url in enumerate(urls, 1)))]
+
+@st.cache_resource
+def get_thumbnailer():
+    store = thumbnails.ThumbnailStore(thumbnail_dir())
+    return thumbnails.ThumbnailWorker(store, template=thumbnail_source()).start()
+
+def _queue_thumbnails(rows):
+    if not thumbnail_base_url():
+        return
+    try:
+        worker = get_thumbnailer()
+        for row in rows:
+            if row.get('is_public'):
+                worker.add(row)
+    except Exception: pass
+
+def build_quiz_record(email, draft, is_public, price):
+    """quizzes テーブルへ登録する行を作成 (一覧用の列もここで計算)"""
+    return {
+        "email": email, "title": draft['main_heading'], "content": draft,
+        "is_public": is_public, "price": price,
+        "summary": make_summary(draft),
+        "image_keyword": draft.get('image_keyword') or 'abstract',
+    }
+
+# 並べ替え -> 並び順の列 (同値のときは id で順序を一意にする)
+# トレンド順は最近の閲覧・いいねほど重く数えたスコア (trending.py。差分の書き込み時に加算される)
+PORTAL_SORT_COLUMNS = {"新着順": "created_at", "トレンド順": "trend_score", "閲覧数順": "views", "いいね順": "likes"}
+
+def fetch_portal_page(repo, sort_order, page, per_page, cursors=None):
+    """ポータル一覧の1ページ分を取得
+
+    cursors は {ページ番号: そのページ末尾の (並び順の値, id)} の辞書。
+    直前ページのカーソルがあればキーセット方式 (OFFSETなし) で取得し、
+    ない場合 (ページ番号へのジャンプ等) や cursors=None のときは OFFSET で取得する。
+    """
+    column = PORTAL_SORT_COLUMNS[sort_order]
+    prev = cursors.get(page - 1) if cursors is not None and page > 1 else None
+    with metrics.timed("db.list_page"):
+        rows = repo.list_page(column, per_page, offset=(page - 1) * per_page, after=prev, columns=PORTAL_CARD_COLUMNS)
+    if cursors is not None and rows:
+        cursors[page] = (rows[-1][column], rows[-1]['id'])
+    return rows
+
+# 総件数の取得方法: "exact" (毎回全件カウント) / "planned" / "estimated" (実行計画の推定値)
+# / "cached" (exact の結果を COUNT_CACHE_TTL 秒だけ使い回す)
+COUNT_CACHE_TTL = 60
+_count_cache = {"value": None, "at": 0.0}
+
+def count_public_quizzes(repo, mode="cached"):
+    if mode == "cached":
+        if _count_cache["value"] is not None and time.time() - _count_cache["at"] < COUNT_CACHE_TTL:
+            return _count_cache["value"]
+        value = count_public_quizzes(repo, "exact")
+        _count_cache.update(value=value, at=time.time())
+        return value
+    with metrics.timed("db.count"):
+        return repo.count_public(mode)
+
+# ポータル一覧の (並べ替え, ページ) ごとのスナップショット (全セッション共通)
+PORTAL_SNAPSHOT_TTL = 30       # 秒: この間は DB を見に行かない
+PORTAL_SNAPSHOT_MAX_AGE = 600  # 秒: この間は古い内容を返しつつ裏で更新する
+PORTAL_SNAPSHOTS = cache.SWRCache(PORTAL_SNAPSHOT_TTL, PORTAL_SNAPSHOT_MAX_AGE)
+_portal_cursors = {}  # (並べ替え, 1ページの件数) -> {ページ番号: カーソル}
+
+def get_portal_page(repo, sort_order, page, per_page, count_mode="cached", keyset=True):
+    """ポータル一覧の1ページ分と総件数 {"rows": [...], "total_count": n} を返す"""
+    def load():
+        # ページの境目は per_page で変わるので、カーソルも件数ごとに分ける
+        cursors = _portal_cursors.setdefault((sort_order, per_page), {}) if keyset else None
+        rows = fetch_portal_page(repo, sort_order, page, per_page, cursors)
+        total_count = count_public_quizzes(repo, count_mode)
+        # 推定件数が実際より少ない場合でも、取得できたページまでは表示する
+        return {"rows": rows, "total_count": max(total_count, (page - 1) * per_page + len(rows))}
+    return PORTAL_SNAPSHOTS.get((sort_order, page, per_page, count_mode, keyset), load)
 
 @st.cache_resource
 def init_supabase():
     if "supabase" in st.secrets:
-        return create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
+        return get_supabase_module().create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
     return None
 
-def delete_quiz(supabase, quiz_id):
+def connect_supabase(url=None, key=None):
+    """Streamlit 外 (バッチ・別サーバー) 用の接続。引数 → 環境変数 → secrets.toml の順に参照"""
+    url = url or os.environ.get("SUPABASE_URL")
+    key = key or os.environ.get("SUPABASE_KEY")
+    if not (url and key):
+        try:
+            url, key = st.secrets["supabase"]["url"], st.secrets["supabase"]["key"]
+        except Exception:
+            return None
+    return get_supabase_module().create_client(url, key)
+
+def _sqlite_path():
+    """ローカル SQLite の保存先 (環境変数 QUIZ_SQLITE_PATH または secrets の [sqlite])"""
+    path = os.environ.get("QUIZ_SQLITE_PATH")
+    if path is None:
+        try:
+            path = st.secrets["sqlite"]["path"]
+        except Exception:
+            path = None
+    return path or None
+
+@st.cache_resource
+def init_storage():
+    """診断データの保存先。SQLite の指定があればローカル、なければ Supabase"""
+    path = _sqlite_path()
+    if path:
+        return storage.SQLiteRepository(path)
+    client = init_supabase()
+    return storage.SupabaseRepository(client) if client else None
+
+def connect_storage(url=None, key=None, sqlite_path=None):
+    """Streamlit 外 (バッチ・別サーバー) 用の保存先"""
+    path = sqlite_path or _sqlite_path()
+    if path:
+        return storage.SQLiteRepository(path)
+    client = connect_supabase(url, key)
+    return storage.SupabaseRepository(client) if client else None
+
+def iter_quizzes(repo, columns="*", public_only=False, page_size=500):
+    """quizzes テーブルを id 順に少しずつ読み出す (全件をメモリに載せない)"""
+    return repo.iter_all(columns, public_only, page_size)
+
+# id で引く診断データのキャッシュ (全セッション共通)
+# 行には content_hash も入れておき、描画キャッシュのキー・ETag に使い回す
+QUIZ_COLUMNS = "id, title, content, is_public"
+QUIZ_CACHE_TTL = 300  # 秒
+QUIZ_CACHE = cache.LRUCache(
+    max_bytes=16 * 1024 * 1024, max_items=2000, ttl=QUIZ_CACHE_TTL,
+    sizeof=lambda row: len(json.dumps(row, ensure_ascii=False, default=str).encode("utf-8")),
+)
+
+def get_quiz(repo, quiz_id):
+    """診断1件を取得 (見つからなければ None)"""
+    quiz = QUIZ_CACHE.get(quiz_id)
+    if quiz is None:
+        with metrics.timed("db.get"):
+            quiz = repo.get(quiz_id, QUIZ_COLUMNS)
+        if quiz is None:
+            return None
+        quiz['content_hash'] = content_hash(quiz.get('content') or {})
+        QUIZ_CACHE.set(quiz_id, quiz)
+    return quiz
+
+def _invalidate_quiz(quiz_id):
+    QUIZ_CACHE.delete(quiz_id)
+    _count_cache["value"] = None
+    PORTAL_SNAPSHOTS.clear()
+    _portal_cursors.clear()
+
+def insert_quiz(repo, record):
+    """診断を登録して新しい行を返す"""
+    with metrics.timed("db.insert"):
+        row = repo.insert(record)
+    _invalidate_quiz(row['id'])
+    _index_quizzes(repo, [row])
+    _queue_thumbnails([row])
+    return row
+
+def insert_quizzes(repo, records):
+    """診断をまとめて登録して新しい行のリストを返す (一括インポート用)"""
+    with metrics.timed("db.insert_many"):
+        rows = repo.insert_many(records)
+    if rows:
+        for row in rows:
+            QUIZ_CACHE.delete(row['id'])
+        _invalidate_quiz(rows[-1]['id'])
+        _index_quizzes(repo, rows)
+        _queue_thumbnails(rows)
+    return rows
+
+def delete_quiz(repo, quiz_id):
     try:
-        supabase.table("quizzes").delete().eq("id", quiz_id).execute()
+        with metrics.timed("db.delete"):
+            repo.delete(quiz_id)
+        _invalidate_quiz(quiz_id)
+        _unindex_quiz(repo, quiz_id)
         return True
-    except: return False
+    except Exception: return False
 
-def increment_views(supabase, quiz_id):
-    try: supabase.rpc("increment_views", {"row_id": quiz_id}).execute()
-    except: pass
+# キーワード検索 (ローカルの検索索引。登録・削除・閲覧数の書き込みに合わせて更新する)
+SEARCH_COLUMNS = "id, title, content, is_public, summary, image_keyword, views, likes, created_at"
+SEARCH_RESULTS = 30
 
-def increment_likes(supabase, quiz_id):
+def search_index_path():
+    return os.environ.get("QUIZ_SEARCH_INDEX") or search.SEARCH_INDEX_PATH
+
+@st.cache_resource
+def _open_search_index(path):
+    return search.SearchIndex(path)
+
+@st.cache_resource
+def get_search_index(_repo):
+    """検索索引。まだ作られていなければ、保存先の公開中の診断からバックグラウンドで作る"""
+    index = _open_search_index(search_index_path())
+    if not index.is_built():
+        threading.Thread(
+            target=lambda: index.rebuild(iter_quizzes(_repo, SEARCH_COLUMNS, public_only=True)),
+            name="search-rebuild", daemon=True,
+        ).start()
+    return index
+
+def search_quizzes(repo, query, limit=SEARCH_RESULTS):
+    """キーワードに一致する公開中の診断 (カード表示用の列)"""
     try:
-        supabase.rpc("increment_likes", {"row_id": quiz_id}).execute()
-        return True
-    except: return False
+        with metrics.timed("search"):
+            return get_search_index(repo).search(query, limit)
+    except Exception: return []
+
+def get_search_index_if_built():
+    """作成済みの検索索引。なければ None (索引の作成・作り直しは始めない)"""
+    path = search_index_path()
+    if not os.path.exists(path):
+        return None
+    index = _open_search_index(path)
+    return index if index.is_built() else None
+
+def _index_quizzes(repo, rows):
+    try:
+        with metrics.timed("search.index"):
+            get_search_index(repo).add_many(rows)
+    except Exception: pass
+
+def _unindex_quiz(repo, quiz_id):
+    try:
+        with metrics.timed("search.index"):
+            get_search_index(repo).remove(quiz_id)
+    except Exception: pass
+
+def cache_stats():
+    """管理者向け: キャッシュ・バッファの状態"""
+    return {
+        "quiz_cache": QUIZ_CACHE.stats(),
+        "render_cache": RENDER_CACHE.stats(),
+        "portal_snapshots": PORTAL_SNAPSHOTS.stats(),
+    }
+
+# 閲覧数・いいね数はプロセス内でまとめてから1回のRPCで書き込む
+COUNTER_FLUSH_INTERVAL = 5.0  # 秒
+COUNTER_FLUSH_SIZE = 500      # これだけの quiz_id が溜まったら即書き込み
+
+@st.cache_resource
+def get_counter_buffer(_repo):
+    def flush(deltas):
+        with metrics.timed("db.increment_counters"):
+            _repo.increment_counters(deltas)
+        # 閲覧数の書き込みは play_server や一括登録の CLI からも行われるので、
+        # 索引がまだなければ作らずに飛ばす (並び順の加点が少し古くなるだけ)
+        try:
+            index = get_search_index_if_built()
+            if index is not None:
+                with metrics.timed("search.update_counters"):
+                    index.update_counters(deltas)
+        except Exception: pass
+    return counters.CounterBuffer(flush, COUNTER_FLUSH_INTERVAL, COUNTER_FLUSH_SIZE).start()
+
+@st.cache_resource
+def get_trend_rebaser(_repo):
+    """トレンド順のスコアの基準時刻を定期的に移すスレッド (並び順は変わらない)"""
+    def rebase(max_age):
+        with metrics.timed("db.rebase_trend"):
+            rebased = _repo.rebase_trend(max_age)
+        if rebased:
+            # スコアの値が変わるので、以前のカーソル・スナップショットは使えない
+            for key in [k for k in list(_portal_cursors) if k[0] == "トレンド順"]:
+                _portal_cursors.pop(key, None)
+            PORTAL_SNAPSHOTS.clear()
+        return rebased
+    return trending.Rebaser(rebase).start()
+
+def increment_views(repo, quiz_id):
+    with metrics.timed("increment_views"):
+        get_counter_buffer(repo).add(quiz_id, views=1)
+
+def increment_likes(repo, quiz_id):
+    with metrics.timed("increment_likes"):
+        return get_counter_buffer(repo).add(quiz_id, likes=1)
+
+# 回答・結果のイベントもまとめてから書き込む (生イベントの INSERT と集計の加算)
+EVENT_FLUSH_INTERVAL = 10.0  # 秒
+EVENT_FLUSH_SIZE = 2000      # これだけのイベントが溜まったら即書き込み
+
+@st.cache_resource
+def get_event_buffer(_repo):
+    def flush(rows, deltas):
+        with metrics.timed("db.record_events"):
+            _repo.record_events(rows, deltas)
+    return analytics.EventBuffer(flush, EVENT_FLUSH_INTERVAL, EVENT_FLUSH_SIZE).start()
+
+def record_events(repo, payload):
+    """ブラウザから届いたイベントを検証してバッファに積む。受け付けた件数を返す"""
+    rows = analytics.parse_payload(payload)
+    return get_event_buffer(repo).add(rows) if rows else 0
+
+def get_quiz_rollup(repo, quiz_id):
+    """診断ごとの集計 (開始数・完了数・結果の分布・質問ごとの回答数)"""
+    try:
+        with metrics.timed("db.get_rollup"):
+            return repo.get_rollup(quiz_id)
+    except Exception: return None
+
+def get_quiz_content(repo, quiz_id):
+    """「コピーして作る」用に content だけを後から取得"""
+    try:
+        quiz = get_quiz(repo, quiz_id)
+        return quiz['content'] if quiz else None
+    except Exception: return None
@@ -0,0 +1,192 @@
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+from email.mime.text import MIMEText
+
+import metrics
+
+OUTBOX_PATH = os.path.join(".cache", "outbox.sqlite3")
+MAX_ATTEMPTS = 6
+RETRY_BASE_DELAY = 30.0   # 秒 (失敗するたびに2倍)
+IDLE_DISCONNECT = 60.0    # 秒: これだけ送信がなければ SMTP 接続を閉じる
+
+
+class Outbox:
+    """送信待ちメールを保存する SQLite の送信箱 (アプリが落ちても消えない)"""
+
+    def __init__(self, path=OUTBOX_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                to_addr TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                sent_at REAL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+        self._conn.commit()
+
+    def add(self, to_addr, subject, body):
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO outbox (to_addr, subject, body, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (to_addr, subject, body, now, now),
+            )
+            self._conn.commit()
+            return cur.lastrowid
+
+    def due(self, limit=20):
+        with self._lock:
+            return self._conn.execute(
+                """SELECT id, to_addr, subject, body, attempts FROM outbox
+                   WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?""",
+                (time.time(), limit),
+            ).fetchall()
+
+    def mark_sent(self, message_id):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = 'sent', sent_at = ? WHERE id = ?", (time.time(), message_id))
+            self._conn.commit()
+
+    def mark_failed(self, message_id, attempts, error):
+        """再試行を予約する。上限に達したら failed にする"""
+        attempts += 1
+        status = "failed" if attempts >= MAX_ATTEMPTS else "pending"
+        next_at = time.time() + RETRY_BASE_DELAY * 2 ** (attempts - 1)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, attempts, next_at, str(error)[:500], message_id),
+            )
+            self._conn.commit()
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+
+class SMTPConnection:
+    """使い回す SMTP 接続。切れていたら次の送信時に自動で接続・ログインし直す"""
+
+    def __init__(self, host, port, username=None, password=None, use_ssl=True, starttls=False, timeout=30):
+        self.host, self.port = host, port
+        self.username, self.password = username, password
+        self.use_ssl, self.starttls = use_ssl, starttls
+        self.timeout = timeout
+        self._server = None
+        self.last_used = 0.0
+        self.logins = 0
+
+    def _connect(self):
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                server.starttls()
+        if self.username and self.password:
+            server.login(self.username, self.password)
+            self.logins += 1
+        return server
+
+    def _alive(self):
+        try:
+            return self._server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, msg):
+        if self._server is None or not self._alive():
+            self.close()
+            self._server = self._connect()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # 送信の直前に切られた場合は1回だけ繋ぎ直す
+            self._server = self._connect()
+            self._server.send_message(msg)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+
+class Mailer:
+    """送信箱に入れたメールをバックグラウンドのスレッドで送る"""
+
+    def __init__(self, sender, connection, outbox=None, poll_interval=5.0):
+        self.sender = sender
+        self.connection = connection
+        self.outbox = outbox or Outbox()
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mailer", daemon=True)
+            self._thread.start()
+        return self
+
+    def enqueue(self, to_addr, subject, body):
+        """送信箱に入れてすぐに戻る (送信はバックグラウンド)"""
+        message_id = self.outbox.add(to_addr, subject, body)
+        self._wake.set()
+        return message_id
+
+    def run_once(self):
+        """送信予定時刻を過ぎたメールを送り、送れた件数を返す"""
+        sent = 0
+        for message_id, to_addr, subject, body, attempts in self.outbox.due():
+            msg = MIMEText(body)
+            msg['Subject'] = subject
+            msg['From'] = self.sender
+            msg['To'] = to_addr
+            try:
+                with metrics.timed("smtp.send"):
+                    self.connection.send(msg)
+            except Exception as e:
+                self.outbox.mark_failed(message_id, attempts, e)
+                self.connection.close()
+                continue
+            self.outbox.mark_sent(message_id)
+            sent += 1
+        return sent
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval + 5)
+        self.connection.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                metrics.count_error("mailer.outbox")  # 送信箱の読み書きに失敗しても次の周期でやり直す
+            if self.connection.last_used and time.monotonic() - self.connection.last_used > IDLE_DISCONNECT:
+                self.connection.close()
+                self.connection.last_used = 0.0
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
@@ -0,0 +1,159 @@
+"""処理段階ごとの所要時間とエラー数 (Prometheus のテキスト形式で出力できる)
+
+    with metrics.timed("db.get"):
+        ...
+
+timed() の中で例外が起きると quiz_stage_errors_total に数えてから、そのまま送出する。
+start_trace() を呼んだスレッドでは、timed() の記録がそのスレッドの trace() にも残るので、
+Streamlit の1回の再実行 (rerun) の内訳を管理者パネルに表示できる。
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [バケットごとの件数..., 合計, 件数]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self, *labels):
+        """{"count": 件数, "sum": 合計} (なければ None)"""
+        series = self._series.get(labels)
+        return {"count": series[-1], "sum": series[-2]} if series else None
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, series):
+                    cumulative += n
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', _number(bound))])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(series[-2])}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("quiz_stage_seconds", "処理段階ごとの所要時間 (秒)", ("stage",))
+STAGE_ERRORS = Counter("quiz_stage_errors_total", "処理段階ごとのエラー数", ("stage",))
+HTML_PAYLOAD_BYTES = Histogram("quiz_html_payload_bytes", "診断HTMLの送信サイズ (バイト)", ("path",), SIZE_BUCKETS)
+
+_trace = threading.local()
+
+
+def start_trace():
+    """このスレッドの記録を始める (Streamlit では再実行ごとに呼ぶ)"""
+    _trace.entries = []
+    _trace.started = time.perf_counter()
+    return _trace.entries
+
+
+def trace():
+    """start_trace() 以降の [(段階, 秒, 成功したか), ...] と経過秒数"""
+    entries = getattr(_trace, "entries", None)
+    if entries is None:
+        return [], 0.0
+    return list(entries), time.perf_counter() - _trace.started
+
+
+def stop_trace():
+    _trace.entries = None
+
+
+def record(stage, seconds, ok=True):
+    STAGE_SECONDS.observe(seconds, stage)
+    if not ok:
+        STAGE_ERRORS.inc(stage)
+    entries = getattr(_trace, "entries", None)
+    if entries is not None:
+        entries.append((stage, seconds, ok))
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        # st.stop() / st.rerun() などの制御用の例外はエラーとして数えない
+        record(stage, time.perf_counter() - started, ok=not _is_control_flow(e))
+        raise
+    record(stage, time.perf_counter() - started)
+
+
+def _is_control_flow(error):
+    return type(error).__name__ in ("StopException", "RerunException", "GeneratorExit")
+
+
+def count_error(stage):
+    """timed() の外で握りつぶした例外を数える"""
+    STAGE_ERRORS.inc(stage)
+
+
+def render():
+    """Prometheus のテキスト形式 (text/plain; version=0.0.4)"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
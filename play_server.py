@@ -0,0 +1,230 @@
+"""診断ページだけを返す軽量な ASGI サーバー
+
+    uvicorn play_server:app --host 0.0.0.0 --port 8000
+
+Streamlit アプリを起動せずに /q/<id> (または /?id=<id>) で診断HTMLを返す。
+content のハッシュを ETag にして、ブラウザ・CDN のキャッシュを効かせる。
+/thumbs/<name> ではポータルのカード画像 (thumbnails.py が保存したもの) を返す。
+"""
+import asyncio
+import gzip
+import json
+from urllib.parse import parse_qs
+
+import analytics
+
+import cache
+import logic
+import metrics
+import thumbnails
+
+CACHE_CONTROL = "public, max-age=60, stale-while-revalidate=600"
+# 閲覧数を数えた診断には Cookie を付け、この間の再読み込みは数えない (app.py のセッションごとの1回に相当)
+VIEW_COOKIE_PREFIX = "qv_"
+VIEW_COOKIE_MAX_AGE = 30 * 60
+EVENTS_PATH = "/events"
+METRICS_PATH = "/metrics"
+MAX_EVENT_BODY = 64 * 1024
+THUMBS_PATH = "/thumbs/"
+# 画像のファイル名は中身が変わらないので1年キャッシュさせる。未生成の間はプレースホルダーを短く
+THUMB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PLACEHOLDER_CACHE_CONTROL = "public, max-age=300"
+
+# logic.render_key() -> gzip 済みの本文
+GZIP_CACHE = cache.LRUCache(max_bytes=16 * 1024 * 1024)
+# ファイル名 -> 画像 (保存済みのものだけ)
+THUMB_CACHE = cache.LRUCache(max_bytes=32 * 1024 * 1024)
+
+NOT_FOUND_HTML = """<!DOCTYPE html>
+<html lang="ja"><head><meta charset="UTF-8"><title>診断が見つかりません</title></head>
+<body style="font-family: sans-serif; text-align: center; padding: 3rem;">
+<p>診断が見つかりません。</p><p><a href="/">トップページに戻る</a></p>
+</body></html>"""
+
+_repo = None
+_thumb_store = None
+
+
+def get_repository():
+    global _repo
+    if _repo is None:
+        _repo = logic.connect_storage()
+    return _repo
+
+
+def get_thumb_store():
+    global _thumb_store
+    if _thumb_store is None:
+        _thumb_store = thumbnails.ThumbnailStore(logic.thumbnail_dir())
+    return _thumb_store
+
+
+def _quiz_id_from(scope):
+    path = scope["path"]
+    if path.startswith("/q/"):
+        return path[3:].removesuffix(".html") or None
+    if path == "/":
+        return parse_qs(scope.get("query_string", b"").decode("latin-1")).get("id", [None])[0]
+    return None
+
+
+def _header(scope, name):
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+
+def _cookie_names(scope):
+    return {part.split("=", 1)[0].strip() for part in _header(scope, b"cookie").split(";")}
+
+
+async def _respond(send, status, body=b"", headers=(), head_only=False):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": b"" if head_only else body})
+
+
+async def _read_body(receive, limit):
+    """リクエスト本文を読む。limit を超えたら None"""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _handle_events(scope, receive, send):
+    """診断ページから sendBeacon で送られる回答・結果イベントを受け付ける"""
+    cors = [("access-control-allow-origin", "*")]
+    if scope["method"] == "OPTIONS":
+        return await _respond(send, 204, headers=cors + [
+            ("access-control-allow-methods", "POST"),
+            ("access-control-allow-headers", "content-type"),
+            ("access-control-max-age", "86400"),
+        ])
+    if scope["method"] != "POST":
+        return await _respond(send, 405, headers=[("allow", "POST, OPTIONS")])
+    repo = get_repository()
+    if repo is None:
+        return await _respond(send, 503, headers=cors)
+    body = await _read_body(receive, MAX_EVENT_BODY)
+    if body is None:
+        return await _respond(send, 413, headers=cors)
+    try:
+        logic.record_events(repo, json.loads(body))
+    except (ValueError, analytics.InvalidPayload):
+        return await _respond(send, 400, headers=cors)
+    await _respond(send, 204, headers=cors)
+
+
+async def _handle_thumb(scope, send, head_only):
+    name = scope["path"][len(THUMBS_PATH):]
+    data = THUMB_CACHE.get(name)
+    if data is None:
+        data = await asyncio.to_thread(get_thumb_store().read, name)
+        if data is not None:
+            THUMB_CACHE.set(name, data)
+    if data is None:
+        return await _respond(send, 200, thumbnails.PLACEHOLDER_SVG, [
+            ("content-type", "image/svg+xml"), ("cache-control", PLACEHOLDER_CACHE_CONTROL),
+            ("content-length", str(len(thumbnails.PLACEHOLDER_SVG))),
+        ], head_only)
+    etag = f'"{name}"'
+    headers = [("etag", etag), ("cache-control", THUMB_CACHE_CONTROL)]
+    if etag in [t.strip() for t in _header(scope, b"if-none-match").split(",")]:
+        return await _respond(send, 304, headers=headers)
+    headers += [("content-type", thumbnails.content_type(name)), ("content-length", str(len(data)))]
+    await _respond(send, 200, data, headers, head_only)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # 溜まっている閲覧数・イベントを書き込んでから終了する
+            if _repo is not None:
+                await asyncio.to_thread(logic.get_counter_buffer(_repo).close)
+                await asyncio.to_thread(logic.get_event_buffer(_repo).close)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == EVENTS_PATH:
+        return await _handle_events(scope, receive, send)
+    if scope["path"] == METRICS_PATH:
+        body = metrics.render().encode("utf-8")
+        return await _respond(send, 200, body, [("content-type", "text/plain; version=0.0.4; charset=utf-8")])
+
+    method = scope["method"]
+    if method not in ("GET", "HEAD"):
+        return await _respond(send, 405, headers=[("allow", "GET, HEAD")])
+    head_only = method == "HEAD"
+
+    if scope["path"].startswith(THUMBS_PATH):
+        return await _handle_thumb(scope, send, head_only)
+
+    quiz_id = _quiz_id_from(scope)
+    repo = get_repository()
+    if not quiz_id or repo is None:
+        return await _respond(send, 404, NOT_FOUND_HTML.encode("utf-8"),
+                              [("content-type", "text/html; charset=utf-8")], head_only)
+
+    # キャッシュに無い場合だけ DB を見に行く (同期クライアントなので別スレッドで)
+    quiz = logic.QUIZ_CACHE.get(quiz_id) or await asyncio.to_thread(logic.get_quiz, repo, quiz_id)
+    if not quiz:
+        return await _respond(send, 404, NOT_FOUND_HTML.encode("utf-8"),
+                              [("content-type", "text/html; charset=utf-8")], head_only)
+
+    # イベントの送信先は同じサーバーの /events (ANALYTICS_EVENTS_URL があればそちら)
+    # 本文には quiz_id と送信先も埋め込まれるので、ETag・gzip のキーは描画キャッシュのキーから作る
+    content = quiz['content']
+    events_url = logic.analytics_events_url() or EVENTS_PATH
+    key = logic.render_key(content, True, events_url, quiz_id, quiz.get('content_hash'))
+    etag = logic.render_etag(key)
+    headers = [("etag", etag), ("cache-control", CACHE_CONTROL), ("vary", "Accept-Encoding")]
+    if etag in [t.strip() for t in _header(scope, b"if-none-match").split(",")]:
+        return await _respond(send, 304, headers=headers)
+
+    # 閲覧数は本文を返す GET だけで数える (再検証の 304 や HEAD の死活監視は数えない)
+    view_cookie = VIEW_COOKIE_PREFIX + quiz_id
+    if not head_only and view_cookie not in _cookie_names(scope):
+        logic.increment_views(repo, quiz_id)
+        # Set-Cookie 付きの応答は共有キャッシュに保存させない
+        headers = [h for h in headers if h[0] != "cache-control"] + [
+            ("cache-control", "private, max-age=60"),
+            ("set-cookie", f"{view_cookie}=1; Max-Age={VIEW_COOKIE_MAX_AGE}; Path=/; HttpOnly; SameSite=Lax"),
+        ]
+
+    body = logic.generate_html_content(content, standalone=True, events_url=events_url, quiz_id=quiz_id,
+                                       digest=key[0]).encode("utf-8")
+    headers.append(("content-type", "text/html; charset=utf-8"))
+    if "gzip" in _header(scope, b"accept-encoding"):
+        body = GZIP_CACHE.get_or_set(key, lambda: gzip.compress(body, 6))
+        headers.append(("content-encoding", "gzip"))
+    metrics.HTML_PAYLOAD_BYTES.observe(len(body), "q")
+    headers.append(("content-length", str(len(body))))
+    await _respond(send, 200, body, headers, head_only)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
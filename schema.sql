@@ -0,0 +1,163 @@
+-- 診断クイズメーカー: Supabase (PostgreSQL) 用のスキーマ変更
+-- 既存の quizzes テーブルに対して、SQL Editor から上から順に実行してください。
+
+-- ポータル一覧用の列 (登録時に logic.build_quiz_record が書き込む)
+alter table quizzes add column if not exists summary text;
+alter table quizzes add column if not exists image_keyword text;
+
+-- 既存データの埋め戻し
+update quizzes
+set summary = left(regexp_replace(coalesce(content->>'intro_text', ''), '\s+', ' ', 'g'), 120),
+    image_keyword = coalesce(nullif(content->>'image_keyword', ''), 'abstract')
+where summary is null;
+
+-- ポータル一覧のキーセット方式ページネーション用 (並び順の列, id) の複合インデックス
+create index if not exists quizzes_public_created_idx on quizzes (created_at desc, id desc) where is_public;
+create index if not exists quizzes_public_views_idx on quizzes (views desc, id desc) where is_public;
+create index if not exists quizzes_public_likes_idx on quizzes (likes desc, id desc) where is_public;
+
+-- トレンド順 (trending.py): 閲覧・いいねを、起きた時刻に応じた重み
+-- 2 ^ ((時刻 - 基準時刻) / 半減期) で trend_score に足していく。
+-- 半減期 86400 秒・いいねの重み 5・登録時の重み 5 は trending.py と同じ値にする。
+create table if not exists trend_state (
+  id int primary key check (id = 1),
+  epoch timestamptz not null
+);
+insert into trend_state (id, epoch) values (1, now()) on conflict (id) do nothing;
+
+create or replace function trend_factor(at timestamptz)
+returns double precision
+language sql
+stable
+as $$
+  select power(2.0, extract(epoch from at - epoch) / 86400.0)::double precision
+  from trend_state where id = 1;
+$$;
+
+alter table quizzes add column if not exists trend_score double precision not null default 0;
+alter table quizzes alter column trend_score set default 5 * trend_factor(now());
+
+-- 既存データの埋め戻し (これまでの閲覧数・いいね数は登録時に付いたものとみなす)
+update quizzes
+set trend_score = (5 + coalesce(views, 0) + 5 * coalesce(likes, 0)) * trend_factor(created_at)
+where trend_score = 0;
+
+create index if not exists quizzes_public_trend_idx on quizzes (trend_score desc, id desc) where is_public;
+
+-- 閲覧数・いいね数のまとめ書き込み (logic.get_counter_buffer から呼ばれる)
+-- deltas: [{"id": "...", "views": 3, "likes": 1}, ...]
+-- trend_state を共有ロックして、基準時刻の移動 (rebase_trend_scores) と重ならないようにする
+create or replace function increment_counters(deltas jsonb)
+returns void
+language plpgsql
+as $$
+declare
+  f double precision;
+begin
+  select power(2.0, extract(epoch from now() - epoch) / 86400.0) into f
+  from trend_state where id = 1 for share;
+
+  update quizzes q
+  set views = coalesce(q.views, 0) + d.views,
+      likes = coalesce(q.likes, 0) + d.likes,
+      trend_score = q.trend_score + (d.views + 5 * d.likes) * f
+  from jsonb_to_recordset(deltas) as d(id uuid, views int, likes int)
+  where q.id = d.id;
+end;
+$$;
+
+-- 基準時刻が max_age_seconds より古ければ、全件の trend_score を縮めて基準時刻を今に移す
+-- (logic.get_trend_rebaser から呼ばれる。移したら true)
+create or replace function rebase_trend_scores(max_age_seconds double precision)
+returns boolean
+language plpgsql
+as $$
+declare
+  old_epoch timestamptz;
+begin
+  select epoch into old_epoch from trend_state where id = 1 for update;
+  if extract(epoch from now() - old_epoch) < max_age_seconds then
+    return false;
+  end if;
+  update quizzes
+  set trend_score = trend_score / power(2.0, extract(epoch from now() - old_epoch) / 86400.0)
+  where trend_score <> 0;
+  update trend_state set epoch = now() where id = 1;
+  return true;
+end;
+$$;
+
+-- 回答データ: ブラウザから届いた生イベント (logic.get_event_buffer がまとめて INSERT する)
+-- quiz_id は検証前の値も入りうるので外部キーにはしない
+create table if not exists quiz_events (
+  id bigint generated always as identity primary key,
+  quiz_id text not null,
+  session text,
+  type text not null,
+  question int,
+  choice int,
+  result text,
+  created_at timestamptz not null default now()
+);
+create index if not exists quiz_events_quiz_idx on quiz_events (quiz_id, created_at);
+
+-- 診断ごとの集計 (画面はこちらだけを読む)
+-- results: {"結果タイプ": 件数}, answered: {"質問番号": 回答数}
+create table if not exists quiz_rollups (
+  quiz_id text primary key,
+  starts bigint not null default 0,
+  completions bigint not null default 0,
+  results jsonb not null default '{}',
+  answered jsonb not null default '{}',
+  updated_at timestamptz not null default now()
+);
+
+-- {"A": 1, "B": 2} + {"A": 3} -> {"A": 4, "B": 2}
+create or replace function jsonb_add_counts(a jsonb, b jsonb)
+returns jsonb
+language sql
+immutable
+as $$
+  select coalesce(jsonb_object_agg(key, total), '{}'::jsonb)
+  from (
+    select key, sum(value::bigint) as total
+    from (
+      select * from jsonb_each_text(coalesce(a, '{}'))
+      union all
+      select * from jsonb_each_text(coalesce(b, '{}'))
+    ) s
+    group by key
+  ) t;
+$$;
+
+-- 集計の差分をまとめて加算する (record_quiz_events から呼ばれる)
+-- deltas: [{"quiz_id": "...", "starts": 3, "completions": 2, "results": {...}, "answered": {...}}, ...]
+create or replace function apply_quiz_rollups(deltas jsonb)
+returns void
+language sql
+as $$
+  insert into quiz_rollups as r (quiz_id, starts, completions, results, answered)
+  select d.quiz_id, d.starts, d.completions, coalesce(d.results, '{}'), coalesce(d.answered, '{}')
+  from jsonb_to_recordset(deltas) as d(quiz_id text, starts int, completions int, results jsonb, answered jsonb)
+  on conflict (quiz_id) do update
+  set starts = r.starts + excluded.starts,
+      completions = r.completions + excluded.completions,
+      results = jsonb_add_counts(r.results, excluded.results),
+      answered = jsonb_add_counts(r.answered, excluded.answered),
+      updated_at = now();
+$$;
+
+-- 生イベントの INSERT と集計の加算を1つのトランザクションで行う (logic.get_event_buffer から呼ばれる)
+-- 集計だけが失敗して再試行したときに、同じイベントが二重に INSERT されないようにする
+-- events: [{"quiz_id": "...", "session": "...", "type": "answer", "question": 0, "choice": 2, "result": null}, ...]
+create or replace function record_quiz_events(events jsonb, deltas jsonb)
+returns void
+language plpgsql
+as $$
+begin
+  insert into quiz_events (quiz_id, session, type, question, choice, result)
+  select e.quiz_id, e.session, e.type, e.question, e.choice, e.result
+  from jsonb_to_recordset(events) as e(quiz_id text, session text, type text, question int, choice int, result text);
+  perform apply_quiz_rollups(deltas);
+end;
+$$;
@@ -0,0 +1,151 @@
+"""診断の採点をサーバー側で再現するエンジン (NumPy でまとめて採点)
+
+ブラウザの calcResult() と同じ規則で採点する:
+  * 選択した選択肢の加点 {結果タイプ: 点数} を質問順に足し合わせる
+  * 最高点の結果タイプが複数あれば、回答 (元の選択肢番号) から決まる疑似乱数で1つ選ぶ
+
+    quiz = scoring.compile_quiz(content)
+    winners = scoring.evaluate(quiz, choices)   # choices: (回答数, 質問数) の選択肢番号
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+from logic import answer_points
+
+_MASK = np.uint64(0xFFFFFFFF)
+
+
+@dataclass
+class CompiledQuiz:
+    types: list            # 結果タイプ (content['results'] の順)
+    weights: np.ndarray    # (質問数, 最大選択肢数, タイプ数) の加点
+    option_counts: np.ndarray  # 質問ごとの選択肢数
+
+    @property
+    def num_questions(self):
+        return self.weights.shape[0]
+
+
+def compile_quiz(data):
+    """quiz content を 回答→結果タイプ の加点行列に変換する"""
+    types = list(data.get('results', {}).keys())
+    index = {t: i for i, t in enumerate(types)}
+    questions = data.get('questions', [])
+    max_options = max((len(q['answers']) for q in questions), default=0)
+    weights = np.zeros((len(questions), max_options, len(types)), dtype=np.float64)
+    for qi, q in enumerate(questions):
+        for ai, ans in enumerate(q['answers']):
+            for t, pts in answer_points(ans).items():
+                # 結果に存在しないタイプへの加点は、ブラウザ側でも無視される
+                if t in index:
+                    weights[qi, ai, index[t]] += pts
+    option_counts = np.array([len(q['answers']) for q in questions], dtype=np.int64)
+    return CompiledQuiz(types, weights, option_counts)
+
+
+def _u32(x):
+    return x & _MASK
+
+
+def answer_seeds(choices):
+    """回答ごとの乱数シード (FNV-1a)。ブラウザの answerSeed() と同じ値になる"""
+    choices = np.asarray(choices, dtype=np.uint64)
+    h = np.full(choices.shape[0], 2166136261, dtype=np.uint64)
+    for qi in range(choices.shape[1]):
+        h = _u32((h ^ choices[:, qi]) * np.uint64(16777619))
+    return h
+
+
+def mulberry32(seeds):
+    """ブラウザの mulberry32() を32bit演算で再現した [0, 1) の乱数"""
+    t = _u32(np.asarray(seeds, dtype=np.uint64) + np.uint64(0x6D2B79F5))
+    t = _u32((t ^ (t >> np.uint64(15))) * (t | np.uint64(1)))
+    t = t ^ _u32(t + _u32((t ^ (t >> np.uint64(7))) * (t | np.uint64(61))))
+    return _u32(t ^ (t >> np.uint64(14))).astype(np.float64) / 4294967296.0
+
+
+def score(quiz, choices):
+    """(回答数, タイプ数) の得点。質問の順に足すので浮動小数点の誤差もブラウザと一致する"""
+    choices = np.asarray(choices, dtype=np.int64)
+    scores = np.zeros((choices.shape[0], len(quiz.types)), dtype=np.float64)
+    for qi in range(quiz.num_questions):
+        scores += quiz.weights[qi, choices[:, qi]]
+    return scores
+
+
+def evaluate(quiz, choices, scores=None):
+    """回答ごとの結果タイプ番号 (quiz.types の添字) と、同点だったかどうかを返す
+
+    結果タイプが1つも選ばれない場合 (全タイプが -1 点未満) は -1。
+    """
+    choices = np.asarray(choices, dtype=np.int64)
+    if scores is None:
+        scores = score(quiz, choices)
+    if not quiz.types:
+        return np.full(choices.shape[0], -1, dtype=np.int64), np.zeros(choices.shape[0], dtype=bool)
+    best = np.maximum(scores.max(axis=1), -1.0)
+    candidates = scores == best[:, None]
+    counts = candidates.sum(axis=1)
+    # 候補の中から何番目を選ぶか (ブラウザと同じく floor(乱数 * 候補数))
+    pick = np.floor(mulberry32(answer_seeds(choices)) * counts).astype(np.int64)
+    rank = np.cumsum(candidates, axis=1) - 1
+    chosen = candidates & (rank == pick[:, None])
+    winners = np.where(counts > 0, chosen.argmax(axis=1), -1)
+    return winners, counts > 1
+
+
+def distribution(quiz, winners):
+    """結果タイプごとの件数 {タイプ: 件数}"""
+    counts = np.bincount(winners[winners >= 0], minlength=len(quiz.types))
+    return {t: int(c) for t, c in zip(quiz.types, counts)}
+
+
+# --- 結果バランスのシミュレーション ---
+EXHAUSTIVE_LIMIT = 1 << 20   # 全組み合わせ数がこれ以下なら全列挙する
+SAMPLE_SIZE = 200_000        # それより多い場合の抽出数
+DOMINANT_SHARE = 0.6         # 1つの結果にこれ以上集中したら偏りありとみなす
+
+
+def enumerate_choices(option_counts):
+    """全ての回答の組み合わせ (組み合わせ数, 質問数)"""
+    return np.indices(tuple(option_counts)).reshape(len(option_counts), -1).T
+
+
+def sample_choices(option_counts, size, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, np.asarray(option_counts), size=(size, len(option_counts)))
+
+
+def simulate(quiz, sample_size=SAMPLE_SIZE, seed=0):
+    """全員が各選択肢を同じ確率で選ぶと仮定したときの結果の分布
+
+    combinations: 評価した組み合わせ数 / exhaustive: 全列挙したか
+    shares: 実際に表示される結果の割合 / expected: 同点を均等に分けた場合の割合
+    tie_rate: 同点になった割合 / unreachable: 一度も出ない結果 / dominant: 偏りのある結果
+    """
+    counts = quiz.option_counts
+    if quiz.num_questions == 0 or not quiz.types or (counts == 0).any():
+        return None
+    total = int(np.prod(counts.astype(np.float64)))
+    exhaustive = total <= EXHAUSTIVE_LIMIT
+    choices = enumerate_choices(counts) if exhaustive else sample_choices(counts, sample_size, seed)
+
+    scores = score(quiz, choices)
+    winners, ties = evaluate(quiz, choices, scores)
+    n = len(choices)
+    shares = {t: c / n for t, c in distribution(quiz, winners).items()}
+
+    best = scores.max(axis=1, keepdims=True)
+    top = scores == best
+    expected = (top / top.sum(axis=1, keepdims=True)).mean(axis=0)
+
+    return {
+        "combinations": n,
+        "exhaustive": exhaustive,
+        "shares": shares,
+        "expected": {t: float(e) for t, e in zip(quiz.types, expected)},
+        "tie_rate": float(ties.mean()),
+        "unreachable": [t for t, s in shares.items() if s == 0],
+        "dominant": [t for t, s in shares.items() if s >= DOMINANT_SHARE],
+    }
@@ -0,0 +1,305 @@
+"""ポータルのキーワード検索 (SQLite FTS5 のローカル索引)
+
+日本語は単語の区切りがないため、文字の bigram (2文字ずつずらした並び) を空白区切りの
+トークンにして FTS5 (unicode61) に入れる。検索語も同じく bigram にしてフレーズ検索するので、
+「恋愛」のような2文字の語も部分一致で見つかる。1文字の検索語は、診断に含まれる文字 (unigram) を
+重複なしで入れた chars 列で探す (bigram の前方一致は一致する語が多すぎて遅いため)。
+
+    index = SearchIndex(".cache/search.sqlite3")
+    index.add(quiz)                 # 公開中の診断を登録 (content を含む行)
+    index.search("恋愛 タイプ")      # -> カード表示用の行のリスト
+
+並び順は FTS5 の bm25 (タイトル・結果名を重視) に、閲覧数・いいね数による加点を掛け合わせる。
+「診断」のようにほとんどの診断に含まれる語や1文字の語は、一致する全件の bm25 を計算すると
+遅いので、新しいものから CANDIDATES 件だけを候補にする (関連度の差がほとんどつかないため)。
+索引は保存先 (Supabase / SQLite) とは別のファイルで、登録・削除・閲覧数の書き込みに合わせて
+少しずつ更新する。作り直すときは python search.py rebuild。
+"""
+import argparse
+import math
+import os
+import sqlite3
+import sys
+import threading
+import unicodedata
+
+SEARCH_INDEX_PATH = os.path.join(".cache", "search.sqlite3")
+CANDIDATES = 200        # bm25 で絞り込む候補数 (この中で人気度を加味して並べ替える)
+POPULARITY_WEIGHT = 0.15
+LIKE_WEIGHT = 5         # いいね1件を閲覧何件分とみなすか
+COLUMN_WEIGHTS = (10.0, 3.0, 5.0, 1.0, 1.0)  # title, intro, results, questions, chars
+MAX_QUERY_TERMS = 8
+COMMON_TERM_DOCS = 5000  # これより多くの診断に含まれる語だけの検索は、新しい順に候補を取る
+
+CARD_FIELDS = ("id", "title", "summary", "image_keyword", "views", "likes", "created_at")
+INDEX_VERSION = "2"      # 索引の列を変えたら上げる (古い索引は作り直す)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    title TEXT,
+    summary TEXT,
+    image_keyword TEXT,
+    views INTEGER NOT NULL DEFAULT 0,
+    likes INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+    title, intro, results, questions, chars,
+    tokenize = 'unicode61 remove_diacritics 0'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_vocab USING fts5vocab(docs_fts, 'row');
+"""
+_DROP = """
+DROP TABLE IF EXISTS docs_vocab;
+DROP TABLE IF EXISTS docs_fts;
+DROP TABLE IF EXISTS docs;
+DELETE FROM meta;
+"""
+
+
+def _is_word_char(ch):
+    return unicodedata.category(ch)[0] in "LNM"
+
+
+def _words(text):
+    """NFKC 正規化・小文字化して、文字・数字の連続ごとに分ける"""
+    word = []
+    for ch in unicodedata.normalize("NFKC", text or "").lower():
+        if _is_word_char(ch):
+            word.append(ch)
+        elif word:
+            yield "".join(word)
+            word = []
+    if word:
+        yield "".join(word)
+
+
+def _bigrams(word):
+    return [word[i:i + 2] for i in range(len(word) - 1)] or [word]
+
+
+def tokenize(text):
+    """索引用: 単語ごとの bigram を空白区切りにした文字列"""
+    tokens = []
+    for word in _words(text):
+        tokens.extend(_bigrams(word))
+    return " ".join(tokens)
+
+
+def unigrams(*texts):
+    """索引用: texts に含まれる文字を重複なしで空白区切りにした文字列 (1文字の検索語用)"""
+    chars = dict.fromkeys(ch for text in texts for word in _words(text) for ch in word)
+    return " ".join(chars)
+
+
+def _query_words(text):
+    return list(_words(text))[:MAX_QUERY_TERMS]
+
+
+def build_query(text):
+    """検索語を FTS5 の検索式にする (空白区切りの語はすべて含むもの = AND)"""
+    terms = []
+    for word in _query_words(text):
+        if len(word) == 1:
+            terms.append(f'chars : "{word}"')
+        else:
+            terms.append('"' + " ".join(_bigrams(word)) + '"')
+    return " AND ".join(terms)
+
+
+def document(quiz):
+    """診断の行から索引に入れる列 (title, intro, results, questions, chars) を作る"""
+    content = quiz.get("content") or {}
+    results = content.get("results") or {}
+    questions = content.get("questions") or []
+    result_text = " ".join(
+        f"{r.get('title', '')} {r.get('desc', '')}" for r in results.values() if isinstance(r, dict)
+    )
+    question_text = " ".join(
+        " ".join([q.get("question", "")] + [a.get("text", "") for a in q.get("answers", []) if isinstance(a, dict)])
+        for q in questions if isinstance(q, dict)
+    )
+    title = quiz.get("title") or content.get("main_heading")
+    return (
+        tokenize(title),
+        tokenize(content.get("intro_text")),
+        tokenize(result_text),
+        tokenize(question_text),
+        unigrams(title, content.get("intro_text"), result_text, question_text),
+    )
+
+
+def popularity(views, likes):
+    return 1.0 + POPULARITY_WEIGHT * math.log1p((views or 0) + LIKE_WEIGHT * (likes or 0))
+
+
+class SearchIndex:
+    """公開中の診断の検索索引 (1つの接続をロックで共有する)"""
+
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != INDEX_VERSION:
+            # 列の違う古い索引は捨てる (is_built() が False になり、作り直される)
+            self._conn.executescript(_DROP)
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('version', ?)", (INDEX_VERSION,))
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    # --- 更新 ---
+    def _upsert(self, quiz):
+        cur = self._conn.execute(
+            """INSERT INTO docs (id, title, summary, image_keyword, views, likes, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET title = excluded.title, summary = excluded.summary,
+                   image_keyword = excluded.image_keyword, views = excluded.views, likes = excluded.likes
+               RETURNING rowid""",
+            (quiz["id"], quiz.get("title"), quiz.get("summary"), quiz.get("image_keyword"),
+             quiz.get("views") or 0, quiz.get("likes") or 0, quiz.get("created_at")),
+        )
+        rowid = cur.fetchone()[0]
+        self._conn.execute("DELETE FROM docs_fts WHERE rowid = ?", (rowid,))
+        self._conn.execute(
+            "INSERT INTO docs_fts (rowid, title, intro, results, questions, chars) VALUES (?, ?, ?, ?, ?, ?)",
+            (rowid, *document(quiz)),
+        )
+
+    def _remove(self, quiz_id):
+        row = self._conn.execute("SELECT rowid FROM docs WHERE id = ?", (quiz_id,)).fetchone()
+        if row:
+            self._conn.execute("DELETE FROM docs_fts WHERE rowid = ?", (row[0],))
+            self._conn.execute("DELETE FROM docs WHERE rowid = ?", (row[0],))
+
+    def add_many(self, quizzes):
+        """診断を登録・更新する (非公開のものは索引から外す)"""
+        with self._lock:
+            for quiz in quizzes:
+                if quiz.get("is_public"):
+                    self._upsert(quiz)
+                else:
+                    self._remove(quiz["id"])
+            self._conn.commit()
+
+    def add(self, quiz):
+        self.add_many([quiz])
+
+    def remove(self, quiz_id):
+        with self._lock:
+            self._remove(quiz_id)
+            self._conn.commit()
+
+    def update_counters(self, deltas):
+        """閲覧数・いいね数の差分 [{"id", "views", "likes"}, ...] を反映する (並び順の加点用)"""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE docs SET views = views + ?, likes = likes + ? WHERE id = ?",
+                [(d.get("views", 0), d.get("likes", 0), d["id"]) for d in deltas],
+            )
+            self._conn.commit()
+
+    def rebuild(self, quizzes, batch_size=500):
+        """全件を入れ直す (quizzes は content を含む行のイテレータ)"""
+        with self._lock:
+            self._conn.execute("DELETE FROM docs")
+            self._conn.execute("DELETE FROM docs_fts")
+            self._conn.commit()
+        batch, count = [], 0
+        for quiz in quizzes:
+            batch.append(quiz)
+            if len(batch) >= batch_size:
+                self.add_many(batch)
+                count += len(batch)
+                batch = []
+        self.add_many(batch)
+        count += len(batch)
+        with self._lock:
+            self._conn.execute("INSERT INTO docs_fts (docs_fts) VALUES ('optimize')")
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')")
+            self._conn.commit()
+        return count
+
+    # --- 検索 ---
+    def is_built(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone() is not None
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def _is_common(self, words):
+        """どの語も COMMON_TERM_DOCS 件より多くの診断に含まれるか (1文字の語は常に含まれるとみなす)
+
+        AND 検索の一致件数は、いちばん少ない bigram の件数を超えないので、それで見積もる。
+        """
+        rarest = None
+        for word in words:
+            if len(word) == 1:
+                continue
+            for gram in _bigrams(word):
+                row = self._conn.execute("SELECT doc FROM docs_vocab WHERE term = ?", (gram,)).fetchone()
+                docs = row[0] if row else 0
+                rarest = docs if rarest is None else min(rarest, docs)
+        return rarest is None or rarest > COMMON_TERM_DOCS
+
+    def search(self, text, limit=30, candidates=CANDIDATES):
+        """検索語に一致する診断をカード表示用の行 (CARD_FIELDS) で返す"""
+        query = build_query(text)
+        if not query:
+            return []
+        weights = ", ".join(str(w) for w in COLUMN_WEIGHTS)
+        with self._lock:
+            order = "docs_fts.rowid DESC" if self._is_common(_query_words(text)) else "score"
+            rows = self._conn.execute(
+                f"""SELECT d.id, d.title, d.summary, d.image_keyword, d.views, d.likes, d.created_at,
+                           bm25(docs_fts, {weights}) AS score
+                    FROM docs_fts JOIN docs d ON d.rowid = docs_fts.rowid
+                    WHERE docs_fts MATCH ?
+                    ORDER BY {order} LIMIT ?""",
+                (query, max(limit, candidates)),
+            ).fetchall()
+        # bm25 は小さいほど関連が高い (負の値) ので、人気度を掛けてさらに小さくする
+        ranked = sorted(rows, key=lambda r: r[7] * popularity(r[4], r[5]))
+        return [dict(zip(CARD_FIELDS, r[:7])) for r in ranked[:limit]]
+
+
+def main(argv=None):
+    import logic
+
+    parser = argparse.ArgumentParser(description="検索索引の作り直し・検索の確認")
+    parser.add_argument("--index", default=SEARCH_INDEX_PATH)
+    parser.add_argument("--supabase-url", default=None)
+    parser.add_argument("--supabase-key", default=None)
+    parser.add_argument("--sqlite", default=None, help="Supabase の代わりにローカルの SQLite から読む")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="公開中の診断をすべて入れ直す")
+    p_query = sub.add_parser("query", help="検索してみる")
+    p_query.add_argument("text")
+    p_query.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    index = SearchIndex(args.index)
+    if args.command == "query":
+        for row in index.search(args.text, args.limit):
+            print(f"{row['id']}  {row['title']}  (閲覧 {row['views']} / いいね {row['likes']})")
+        return 0
+
+    repo = logic.connect_storage(args.supabase_url, args.supabase_key, args.sqlite)
+    if repo is None:
+        print("保存先の接続情報がありません (SUPABASE_URL / SUPABASE_KEY または QUIZ_SQLITE_PATH)", file=sys.stderr)
+        return 1
+    count = index.rebuild(logic.iter_quizzes(repo, logic.SEARCH_COLUMNS, public_only=True))
+    print(f"{count} 件を索引に登録しました -> {args.index}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
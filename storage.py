@@ -0,0 +1,442 @@
+"""診断データの保存先 (リポジトリ)
+
+アプリ・配信サーバー・バッチは Supabase のクライアントを直接触らず、
+ここのリポジトリ経由で読み書きする。
+
+    SupabaseRepository(client)   本番: Supabase (PostgREST)
+    SQLiteRepository(path)       ローカル: ネットワークなしで全機能を動かす・負荷試験用
+
+どちらも同じメソッドを持つ:
+    get / list_page / count_public / insert / delete / iter_all
+    increment_counters / rebase_trend / record_events / get_rollup
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import trending
+
+QUIZ_FIELDS = (
+    "id", "email", "title", "content", "is_public", "price",
+    "summary", "image_keyword", "views", "likes", "trend_score", "created_at",
+)
+SORT_COLUMNS = ("created_at", "views", "likes", "trend_score")
+
+
+class QuizRepository:
+    """保存先の共通インターフェース"""
+
+    backend = None
+
+    def get(self, quiz_id, columns="*"):
+        """1件を返す (なければ None)"""
+        raise NotImplementedError
+
+    def list_page(self, sort_column, limit, offset=0, after=None, columns="*"):
+        """公開中の診断を sort_column の降順 (同値は id の降順) で返す
+
+        after に直前ページ末尾の (並び順の値, id) を渡すとキーセット方式で続きを返す。
+        """
+        raise NotImplementedError
+
+    def count_public(self, mode="exact"):
+        raise NotImplementedError
+
+    def insert(self, record):
+        """1件登録して、id・created_at の入った行を返す"""
+        raise NotImplementedError
+
+    def insert_many(self, records):
+        """まとめて登録する (1回の往復・1つのトランザクション)。登録した行のリストを返す"""
+        raise NotImplementedError
+
+    def delete(self, quiz_id):
+        raise NotImplementedError
+
+    def iter_all(self, columns="*", public_only=False, page_size=500):
+        """id 順に少しずつ読み出す (全件をメモリに載せない)"""
+        raise NotImplementedError
+
+    def increment_counters(self, deltas):
+        """deltas: [{"id": ..., "views": n, "likes": n}, ...] (trend_score も同時に加算する)"""
+        raise NotImplementedError
+
+    def rebase_trend(self, max_age):
+        """trend_score の基準時刻が max_age 秒より古ければ今に移す。移したら True"""
+        raise NotImplementedError
+
+    def record_events(self, rows, deltas):
+        """回答イベントの行を保存し、集計の差分 (analytics.rollup_deltas) を加算する"""
+        raise NotImplementedError
+
+    def get_rollup(self, quiz_id):
+        raise NotImplementedError
+
+
+# --- Supabase ---
+def _pg_quote(value):
+    """PostgREST のフィルタ値をダブルクォートで囲む (日時の「:」「.」対策)"""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class SupabaseRepository(QuizRepository):
+    backend = "supabase"
+
+    def __init__(self, client):
+        self.client = client
+
+    def _table(self, name="quizzes"):
+        return self.client.table(name)
+
+    def get(self, quiz_id, columns="*"):
+        res = self._table().select(columns).eq("id", quiz_id).execute()
+        return res.data[0] if res.data else None
+
+    def list_page(self, sort_column, limit, offset=0, after=None, columns="*"):
+        query = self._table().select(columns).eq("is_public", True)
+        if after is not None:
+            v, i = _pg_quote(after[0]), _pg_quote(after[1])
+            query = query.or_(f"{sort_column}.lt.{v},and({sort_column}.eq.{v},id.lt.{i})")
+        query = query.order(sort_column, desc=True).order("id", desc=True)
+        if after is not None:
+            query = query.limit(limit)
+        else:
+            query = query.range(offset, offset + limit - 1)
+        return query.execute().data or []
+
+    def count_public(self, mode="exact"):
+        res = self._table().select("id", count=mode).eq("is_public", True).limit(1).execute()
+        return res.count or 0
+
+    def insert(self, record):
+        return self._table().insert(record).execute().data[0]
+
+    def insert_many(self, records):
+        return self._table().insert(list(records)).execute().data or []
+
+    def delete(self, quiz_id):
+        self._table().delete().eq("id", quiz_id).execute()
+
+    def iter_all(self, columns="*", public_only=False, page_size=500):
+        last_id = None
+        while True:
+            query = self._table().select(columns)
+            if public_only:
+                query = query.eq("is_public", True)
+            if last_id is not None:
+                query = query.gt("id", last_id)
+            rows = query.order("id").limit(page_size).execute().data or []
+            yield from rows
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1]['id']
+
+    def increment_counters(self, deltas):
+        self.client.rpc("increment_counters", {"deltas": deltas}).execute()
+
+    def rebase_trend(self, max_age):
+        return bool(self.client.rpc("rebase_trend_scores", {"max_age_seconds": max_age}).execute().data)
+
+    def record_events(self, rows, deltas):
+        # INSERT と集計を1回の RPC (1トランザクション) で行う。失敗したらどちらも反映されない
+        self.client.rpc("record_quiz_events", {"events": rows, "deltas": deltas}).execute()
+
+    def get_rollup(self, quiz_id):
+        res = self._table("quiz_rollups").select("*").eq("quiz_id", quiz_id).limit(1).execute()
+        return res.data[0] if res.data else None
+
+
+# --- SQLite ---
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS quizzes (
+    id TEXT PRIMARY KEY,
+    email TEXT,
+    title TEXT,
+    content TEXT NOT NULL DEFAULT '{}',
+    is_public INTEGER NOT NULL DEFAULT 0,
+    price INTEGER NOT NULL DEFAULT 0,
+    summary TEXT,
+    image_keyword TEXT,
+    views INTEGER NOT NULL DEFAULT 0,
+    likes INTEGER NOT NULL DEFAULT 0,
+    trend_score REAL NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS quizzes_public_created_idx ON quizzes (is_public, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS quizzes_public_views_idx ON quizzes (is_public, views DESC, id DESC);
+CREATE INDEX IF NOT EXISTS quizzes_public_likes_idx ON quizzes (is_public, likes DESC, id DESC);
+
+-- trend_score の基準時刻 (UNIX 秒。1行だけ)
+CREATE TABLE IF NOT EXISTS trend_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    epoch REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS quiz_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    quiz_id TEXT NOT NULL,
+    session TEXT,
+    type TEXT NOT NULL,
+    question INTEGER,
+    choice INTEGER,
+    result TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS quiz_events_quiz_idx ON quiz_events (quiz_id, created_at);
+
+CREATE TABLE IF NOT EXISTS quiz_rollups (
+    quiz_id TEXT PRIMARY KEY,
+    starts INTEGER NOT NULL DEFAULT 0,
+    completions INTEGER NOT NULL DEFAULT 0,
+    results TEXT NOT NULL DEFAULT '{}',
+    answered TEXT NOT NULL DEFAULT '{}',
+    updated_at TEXT NOT NULL
+);
+"""
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _timestamp(value):
+    """created_at (ISO 形式) を UNIX 秒にする (読めなければ現在時刻)"""
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return time.time()
+
+
+def _add_counts(a, b):
+    out = dict(a)
+    for k, v in b.items():
+        out[k] = out.get(k, 0) + v
+    return out
+
+
+class SQLiteRepository(QuizRepository):
+    """ローカルの SQLite に保存する (WAL モード)
+
+    読み込みはスレッドごとの接続で並行に行い、書き込みはロックで1つずつ行う。
+    SQL はすべてプレースホルダ付きの固定文字列なので、sqlite3 の文キャッシュで
+    コンパイル済みの文が使い回される。
+    """
+    backend = "sqlite"
+
+    def __init__(self, path, statement_cache=256):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.statement_cache = statement_cache
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        if path == ":memory:":
+            # インメモリは接続ごとに別DBになるので、1つの接続を共有する
+            self._shared = self._connect()
+        else:
+            self._shared = None
+        conn = self._conn()
+        conn.executescript(SQLITE_SCHEMA)
+        self._migrate(conn)
+        conn.execute("INSERT OR IGNORE INTO trend_state (id, epoch) VALUES (1, ?)", (time.time(),))
+        conn.commit()
+
+    @staticmethod
+    def _migrate(conn):
+        """以前のバージョンで作ったファイルに足りない列を追加する"""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(quizzes)")}
+        if "trend_score" not in columns:
+            conn.execute("ALTER TABLE quizzes ADD COLUMN trend_score REAL NOT NULL DEFAULT 0")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS quizzes_public_trend_idx ON quizzes (is_public, trend_score DESC, id DESC)"
+        )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30,
+                               cached_statements=self.statement_cache)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _conn(self):
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _read(self, sql, params=()):
+        if self._shared is not None:
+            with self._write_lock:
+                return self._shared.execute(sql, params).fetchall()
+        return self._conn().execute(sql, params).fetchall()
+
+    @staticmethod
+    def _columns(columns):
+        if columns.strip() == "*":
+            return QUIZ_FIELDS
+        names = tuple(c.strip() for c in columns.split(","))
+        unknown = [c for c in names if c not in QUIZ_FIELDS]
+        if unknown:
+            raise ValueError(f"unknown columns: {unknown}")
+        return names
+
+    @staticmethod
+    def _row(row):
+        quiz = dict(row)
+        if "content" in quiz:
+            quiz["content"] = json.loads(quiz["content"])
+        if "is_public" in quiz:
+            quiz["is_public"] = bool(quiz["is_public"])
+        return quiz
+
+    def get(self, quiz_id, columns="*"):
+        rows = self._read(f"SELECT {', '.join(self._columns(columns))} FROM quizzes WHERE id = ?", (quiz_id,))
+        return self._row(rows[0]) if rows else None
+
+    def list_page(self, sort_column, limit, offset=0, after=None, columns="*"):
+        if sort_column not in SORT_COLUMNS:
+            raise ValueError(f"unknown sort column: {sort_column}")
+        select = f"SELECT {', '.join(self._columns(columns))} FROM quizzes WHERE is_public = 1"
+        order = f" ORDER BY {sort_column} DESC, id DESC LIMIT ?"
+        if after is not None:
+            rows = self._read(select + f" AND ({sort_column}, id) < (?, ?)" + order, (after[0], after[1], limit))
+        else:
+            rows = self._read(select + order + " OFFSET ?", (limit, offset))
+        return [self._row(r) for r in rows]
+
+    def count_public(self, mode="exact"):
+        return self._read("SELECT COUNT(*) FROM quizzes WHERE is_public = 1")[0][0]
+
+    _INSERT_SQL = f"INSERT INTO quizzes ({', '.join(QUIZ_FIELDS)}) VALUES ({', '.join('?' * len(QUIZ_FIELDS))})"
+
+    @staticmethod
+    def _prepare(record):
+        row = {"id": str(uuid.uuid4()), "created_at": _now(), "views": 0, "likes": 0, "price": 0, **record}
+        row["content"] = json.dumps(row.get("content") or {}, ensure_ascii=False)
+        row["is_public"] = int(bool(row.get("is_public")))
+        return row
+
+    def _epoch(self, conn):
+        return conn.execute("SELECT epoch FROM trend_state WHERE id = 1").fetchone()[0]
+
+    def insert(self, record):
+        return self.insert_many([record])[0]
+
+    def insert_many(self, records):
+        rows = [self._prepare(r) for r in records]
+        with self._write_lock:
+            conn = self._conn()
+            epoch = self._epoch(conn)
+            for row in rows:
+                if row.get("trend_score") is None:
+                    # 登録時刻に CREATED_WEIGHT 件の閲覧があったものとして始める
+                    row["trend_score"] = trending.CREATED_WEIGHT * trending.factor(_timestamp(row["created_at"]), epoch)
+            try:
+                conn.executemany(self._INSERT_SQL, [[row.get(c) for c in QUIZ_FIELDS] for row in rows])
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            conn.commit()
+        return [self._row(row) for row in rows]
+
+    def delete(self, quiz_id):
+        with self._write_lock:
+            conn = self._conn()
+            conn.execute("DELETE FROM quizzes WHERE id = ?", (quiz_id,))
+            conn.commit()
+
+    def iter_all(self, columns="*", public_only=False, page_size=500):
+        names = self._columns(columns)
+        # 続きの位置を決めるために id は必ず読む
+        select = ", ".join(names if "id" in names else ("id",) + names)
+        where = "is_public = 1 AND " if public_only else ""
+        last_id = ""
+        while True:
+            rows = self._read(
+                f"SELECT {select} FROM quizzes WHERE {where}id > ? ORDER BY id LIMIT ?", (last_id, page_size)
+            )
+            for r in rows:
+                quiz = self._row(r)
+                if "id" not in names:
+                    del quiz["id"]
+                yield quiz
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1]["id"]
+
+    def increment_counters(self, deltas):
+        with self._write_lock:
+            conn = self._conn()
+            factor = trending.factor(time.time(), self._epoch(conn))
+            try:
+                conn.executemany(
+                    "UPDATE quizzes SET views = views + ?, likes = likes + ?, trend_score = trend_score + ? WHERE id = ?",
+                    [(d.get("views", 0), d.get("likes", 0),
+                      trending.weight(d.get("views", 0), d.get("likes", 0)) * factor, d["id"]) for d in deltas],
+                )
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def rebase_trend(self, max_age):
+        with self._write_lock:
+            conn = self._conn()
+            epoch, now = self._epoch(conn), time.time()
+            if now - epoch < max_age:
+                return False
+            try:
+                conn.execute("UPDATE quizzes SET trend_score = trend_score * ?", (1.0 / trending.factor(now, epoch),))
+                conn.execute("UPDATE trend_state SET epoch = ? WHERE id = 1", (now,))
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            conn.commit()
+            return True
+
+    def record_events(self, rows, deltas):
+        now = _now()
+        with self._write_lock:
+            conn = self._conn()
+            try:
+                conn.executemany(
+                    "INSERT INTO quiz_events (quiz_id, session, type, question, choice, result, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(r["quiz_id"], r["session"], r["type"], r["question"], r["choice"], r["result"], now)
+                     for r in rows],
+                )
+                for d in deltas:
+                    old = conn.execute(
+                        "SELECT starts, completions, results, answered FROM quiz_rollups WHERE quiz_id = ?",
+                        (d["quiz_id"],),
+                    ).fetchone()
+                    starts, completions, results, answered = (
+                        (old[0], old[1], json.loads(old[2]), json.loads(old[3])) if old else (0, 0, {}, {})
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO quiz_rollups"
+                        " (quiz_id, starts, completions, results, answered, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (d["quiz_id"], starts + d["starts"], completions + d["completions"],
+                         json.dumps(_add_counts(results, d["results"]), ensure_ascii=False),
+                         json.dumps(_add_counts(answered, d["answered"])), now),
+                    )
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def get_rollup(self, quiz_id):
+        rows = self._read("SELECT * FROM quiz_rollups WHERE quiz_id = ?", (quiz_id,))
+        if not rows:
+            return None
+        rollup = dict(rows[0])
+        rollup["results"] = json.loads(rollup["results"])
+        rollup["answered"] = json.loads(rollup["answered"])
+        return rollup
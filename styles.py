@@ -1,8 +1,7 @@
 import streamlit as st
 
-def apply_portal_style():
-    """公開画面用の白ベースデザイン"""
-    st.markdown("""
+# 公開画面用のCSS (静的書き出しの一覧ページでも使う)
+PORTAL_CSS = """
         <style>
         /* 全体設定 */
         .stApp { background-color: #ffffff !important; color: #333333 !important; }
@@ -215,7 +214,28 @@ def apply_portal_style():
             box-shadow: 0 4px 6px -1px rgba(0,0,0,0.05); border: 1px solid #e2e8f0; text-align: center;
         }
         </style>
-    """, unsafe_allow_html=True)
+    """
+
+def apply_portal_style():
+    """公開画面用の白ベースデザイン"""
+    st.markdown(PORTAL_CSS, unsafe_allow_html=True)
+
+# プレイ画面用の最小限のCSS (UI非表示とボタンのみ)
+PLAY_CSS = """
+        <style>
+        .stApp { background-color: #ffffff !important; color: #333333 !important; }
+        .block-container { max-width: 1100px; padding-top: 1rem; padding-bottom: 5rem; }
+        header[data-testid="stHeader"], [data-testid="stToolbar"], [data-testid="stDecoration"], .stDeployButton,
+        [data-testid="stStatusWidget"], #MainMenu, div[class*="viewerBadge"] { display: none !important; }
+        footer { visibility: hidden !important; height: 0 !important; position: fixed !important; left: -9999px !important; }
+        .stButton button { border-radius: 8px !important; font-weight: bold !important; padding: 0.6rem 1rem !important; }
+        .stButton button[kind="secondary"] { background: #fff1f2 !important; color: #e11d48 !important; border: 1px solid #fecdd3 !important; }
+        </style>
+    """
+
+def apply_play_style():
+    """プレイ画面用の軽量デザイン"""
+    st.markdown(PLAY_CSS, unsafe_allow_html=True)
 
 def apply_editor_style():
     """エディタ用の黒ベースデザイン"""
@@ -254,12 +274,17 @@ HERO_HTML = """
 """
 
 # カードの中身
-def get_card_content_html(title, desc, img_url, views=0, likes=0):
+def get_card_content_html(title, desc, img_url, views=0, likes=0, img_sources=()):
+    # img_sources: [(type, srcset)] があれば <picture> で対応ブラウザに別形式を使わせる
+    img = f'<img src="{img_url}" class="card-img" loading="lazy" width="350" height="180">'
+    if img_sources:
+        sources = "".join(f'<source type="{t}" srcset="{srcset}">' for t, srcset in img_sources)
+        img = f"<picture>{sources}{img}</picture>"
     return f"""
     <div class="card-img-box">
         <span class="badge-new">NEW</span>
         <span class="badge-stats">👁️ {views} &nbsp; ❤️ {likes}</span>
-        <img src="{img_url}" class="card-img" loading="lazy">
+        {img}
     </div>
     <div class="quiz-content">
         <div class="quiz-title">{title}</div>
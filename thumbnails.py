@@ -0,0 +1,222 @@
+"""ポータルのカード画像 (サムネイル) の生成・保存
+
+カード画像は AI 画像生成 (pollinations) の URL をそのまま <img> に入れていたので、
+一覧を開くたびにブラウザが外部サービスでの生成を待っていた。
+公開時に1回だけ元画像を取得し、カードの大きさに縮小した WebP / JPEG を THUMB_DIR に保存して、
+play_server の /thumbs/ から長期キャッシュ付きで配信する。
+
+    worker = ThumbnailWorker(ThumbnailStore()).start()
+    worker.add(quiz)                        # 公開時 (バックグラウンドで取得・縮小・保存)
+    filename(thumb_key(source_url(quiz)), (350, 180), "webp")   # -> <key>-350x180.webp
+
+ファイル名は元画像の URL (キーワード・シード・テンプレート) のハッシュなので、
+一覧の行 (id, image_keyword) から DB を見ずに決められ、同じ名前の中身は変わらない。
+まだ生成されていない (または取得に失敗した) 画像は、/thumbs/ がプレースホルダーを返す。
+
+    python thumbnails.py backfill      # 既存の公開中の診断の画像をまとめて生成する
+"""
+import argparse
+import hashlib
+import io
+import os
+import queue
+import re
+import sys
+import threading
+import urllib.parse
+import urllib.request
+
+import metrics
+
+SOURCE_TEMPLATE = "https://image.pollinations.ai/prompt/{keyword}%20{seed}?width={width}&height={height}&nologo=true"
+THUMB_DIR = os.path.join(".cache", "thumbs")
+SIZES = ((350, 180), (700, 360))  # カードの 1x / 2x (元画像は最大の大きさで取得する)
+FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpg": ("JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+FETCH_TIMEOUT = 60             # 秒: AI 画像生成は数秒〜数十秒かかる
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+
+PLACEHOLDER_SVG = b"""<svg xmlns="http://www.w3.org/2000/svg" width="350" height="180" viewBox="0 0 350 180">
+<defs><linearGradient id="g" x1="0" y1="0" x2="1" y2="1">
+<stop offset="0" stop-color="#e0e7ff"/><stop offset="1" stop-color="#fce7f3"/></linearGradient></defs>
+<rect width="350" height="180" fill="url(#g)"/>
+<text x="175" y="100" font-size="40" text-anchor="middle">&#128142;</text>
+</svg>"""
+
+_NAME = re.compile(r"^[0-9a-f]{24}-\d+x\d+\.(webp|jpg)$")
+
+
+def source_url(quiz, template=SOURCE_TEMPLATE):
+    """元画像の URL (従来のカード画像と同じキーワード・シード)"""
+    keyword = urllib.parse.quote(quiz.get('image_keyword') or 'abstract')
+    width, height = SIZES[-1]
+    return template.format(keyword=keyword, seed=quiz['id'][-4:], width=width, height=height)
+
+
+def thumb_key(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:24]
+
+
+def filename(key, size, fmt):
+    return f"{key}-{size[0]}x{size[1]}.{fmt}"
+
+
+def content_type(name):
+    return FORMATS[name.rsplit(".", 1)[-1]][1]
+
+
+def fetch(url, timeout=FETCH_TIMEOUT):
+    """元画像を取得する (file:// の URL も使える)"""
+    request = urllib.request.Request(url, headers={"User-Agent": "shindan-quiz-maker-thumbnailer"})
+    with urllib.request.urlopen(request, timeout=timeout) as res:
+        data = res.read(MAX_SOURCE_BYTES + 1)
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ValueError(f"source image is larger than {MAX_SOURCE_BYTES} bytes: {url}")
+    return data
+
+
+def make_variants(data, key):
+    """元画像を SIZES × FORMATS に縮小 (中央で切り抜き) して {ファイル名: バイト列} を返す"""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as source:
+        image = source.convert("RGB")
+    variants = {}
+    for size in SIZES:
+        resized = ImageOps.fit(image, size, Image.Resampling.LANCZOS)
+        for fmt, (pil_format, _, options) in FORMATS.items():
+            out = io.BytesIO()
+            resized.save(out, pil_format, **options)
+            variants[filename(key, size, fmt)] = out.getvalue()
+    return variants
+
+
+class ThumbnailStore:
+    """縮小済みの画像をローカルのディレクトリに保存する (名前 = 内容が変わらないファイル)"""
+
+    def __init__(self, root=THUMB_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        if not _NAME.match(name):
+            raise ValueError(f"invalid thumbnail name: {name!r}")
+        return os.path.join(self.root, name)
+
+    def has(self, key):
+        return all(os.path.exists(self.path(filename(key, size, fmt))) for size in SIZES for fmt in FORMATS)
+
+    def save(self, variants):
+        for name, data in variants.items():
+            path = self.path(name)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+
+    def read(self, name):
+        """保存済みならバイト列、なければ (不正な名前も) None"""
+        try:
+            with open(self.path(name), "rb") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+
+class ThumbnailWorker:
+    """公開された診断の画像をバックグラウンドで1件ずつ取得・縮小・保存する
+
+    add() はキューに積むだけなので、公開処理を待たせない。キューが max_queued を超えた分や
+    取得に失敗したものは捨てる (カードはプレースホルダーのまま。backfill で作り直せる)。
+    """
+
+    def __init__(self, store, fetch_fn=fetch, template=SOURCE_TEMPLATE, max_queued=1000):
+        self.store = store
+        self._fetch_fn = fetch_fn
+        self.template = template
+        self._queue = queue.Queue(max_queued)
+        self._thread = None
+        self.stats = {"queued": 0, "generated": 0, "skipped": 0, "failed": 0, "dropped": 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="thumbnailer", daemon=True)
+            self._thread.start()
+        return self
+
+    def add(self, quiz):
+        try:
+            self._queue.put_nowait(quiz)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["queued"] += 1
+        return True
+
+    def generate(self, quiz):
+        """1件分を作る。作ったら True、作成済みなら False、失敗したら例外"""
+        url = source_url(quiz, self.template)
+        key = thumb_key(url)
+        if self.store.has(key):
+            self.stats["skipped"] += 1
+            return False
+        with metrics.timed("thumbs.fetch"):
+            data = self._fetch_fn(url)
+        with metrics.timed("thumbs.resize"):
+            variants = make_variants(data, key)
+        self.store.save(variants)
+        self.stats["generated"] += 1
+        return True
+
+    def join(self):
+        """キューに積んだ分が終わるまで待つ"""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            quiz = self._queue.get()
+            try:
+                if quiz is None:
+                    return
+                self.generate(quiz)
+            except Exception:
+                self.stats["failed"] += 1
+            finally:
+                self._queue.task_done()
+
+
+def main(argv=None):
+    import logic
+
+    parser = argparse.ArgumentParser(description="公開中の診断のカード画像をまとめて生成する")
+    parser.add_argument("command", choices=("backfill",))
+    parser.add_argument("--dir", default=None, help="保存先 (省略時は QUIZ_THUMB_DIR または .cache/thumbs)")
+    parser.add_argument("--supabase-url", default=None)
+    parser.add_argument("--supabase-key", default=None)
+    parser.add_argument("--sqlite", default=None, help="Supabase の代わりにローカルの SQLite から読む")
+    args = parser.parse_args(argv)
+
+    repo = logic.connect_storage(args.supabase_url, args.supabase_key, args.sqlite)
+    if repo is None:
+        print("保存先の接続情報がありません (SUPABASE_URL / SUPABASE_KEY または QUIZ_SQLITE_PATH)", file=sys.stderr)
+        return 1
+    worker = ThumbnailWorker(ThumbnailStore(args.dir or logic.thumbnail_dir()), template=logic.thumbnail_source())
+    failed = 0
+    for quiz in logic.iter_quizzes(repo, "id, image_keyword", public_only=True):
+        try:
+            worker.generate(quiz)
+        except Exception as e:
+            failed += 1
+            print(f"  {quiz['id']}: {e}", file=sys.stderr)
+    print(f"生成 {worker.stats['generated']} 件 / 作成済み {worker.stats['skipped']} 件 / 失敗 {failed} 件",
+          file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
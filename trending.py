@@ -0,0 +1,71 @@
+"""トレンド順の並び替えに使うスコア (新しい閲覧・いいねほど重い)
+
+閲覧1件・いいね1件を、起きた時刻に応じた重み 2 ** ((時刻 - 基準時刻) / HALF_LIFE) で
+trend_score 列に足していく。どの診断のスコアも時間とともに同じ割合で減衰するとみなせるので、
+並び順は「HALF_LIFE ごとに半分になる閲覧数・いいね数」の順と同じになり、
+減衰のために全件を書き換える必要がない (差分が届いたときにその行だけを加算する)。
+
+重みは時間とともに大きくなるので、基準時刻が REBASE_AFTER より古くなったら
+全件のスコアを同じ割合で縮めて基準時刻を今に移す (Rebaser がバックグラウンドで行う)。
+並び順は変わらない。
+
+Supabase 側の計算 (schema.sql の trend_factor / increment_counters) も同じ値を使う。
+"""
+import atexit
+import threading
+
+HALF_LIFE = 24 * 3600           # 秒: この時間で閲覧・いいねの重みが半分になる
+LIKE_WEIGHT = 5                 # いいね1件を閲覧何件分とみなすか
+CREATED_WEIGHT = 5              # 登録直後の診断に最初から与える閲覧件数分の重み
+REBASE_AFTER = 7 * 24 * 3600    # 秒: 基準時刻がこれより古くなったら移す
+REBASE_CHECK_INTERVAL = 3600    # 秒: Rebaser が確認する間隔
+
+
+def factor(at, epoch):
+    """時刻 at (UNIX 秒) の閲覧1件の重み"""
+    return 2.0 ** ((at - epoch) / HALF_LIFE)
+
+
+def weight(views=0, likes=0):
+    return views + LIKE_WEIGHT * likes
+
+
+class Rebaser:
+    """基準時刻の移動を定期的に行うバックグラウンドスレッド
+
+    rebase_fn(REBASE_AFTER) は基準時刻が古ければ移して True、まだ新しければ False を返す。
+    """
+
+    def __init__(self, rebase_fn, interval=REBASE_CHECK_INTERVAL, max_age=REBASE_AFTER):
+        self._rebase_fn = rebase_fn
+        self.interval = interval
+        self.max_age = max_age
+        self._stopped = threading.Event()
+        self._thread = None
+        self.stats = {"checks": 0, "rebases": 0, "failures": 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="trend-rebaser", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def run_once(self):
+        self.stats["checks"] += 1
+        try:
+            rebased = self._rebase_fn(self.max_age)
+        except Exception:
+            self.stats["failures"] += 1
+            return False
+        self.stats["rebases"] += bool(rebased)
+        return rebased
+
+    def close(self):
+        self._stopped.set()
+
+    def _run(self):
+        # 起動直後にも1回確認する (長く止まっていた場合に備えて)
+        while not self._stopped.is_set():
+            self.run_once()
+            self._stopped.wait(self.interval)